@@ -11,10 +11,622 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
-import json
+import collections
+import contextlib
+import functools
+import os
+import sys
+import time
+import types
 
+# NOTE: charms.reactive imports this module for every hook, so modules only
+# some code paths need, json and base64 included, are imported where used.
 import charms.reactive as reactive
+from charms.reactive.endpoints import JSONUnitDataView
+from charmhelpers.core import hookenv, unitdata
+
+
+def _as_dict(view):
+    """Copy a relation data view into a plain dict.
+
+    ``UnitDataView`` wraps ``None`` when relation-get returned nothing, which
+    ``dict()`` cannot iterate, so unwrap it first.
+    """
+    return dict(getattr(view, 'data', view) or {})
+
+
+def _publish_changes(bag, data):
+    """Write the keys of ``data`` whose published value differs.
+
+    Leaving the bag untouched when nothing changed avoids a relation-set,
+    and with it a relation-changed hook on the remote side.
+
+    :param bag: relation data bag to publish to
+    :type bag: UnitDataView
+    :param data: key->value payload to publish
+    :type data: dict
+    :returns: the keys and values that were written
+    :rtype: dict
+    """
+    changed = {key: value for key, value in data.items()
+               if bag.get(key) != value}
+    if changed:
+        bag.update(changed)
+    return changed
+
+
+# Ports dropped from URLs by _normalise_url()
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def _normalise_url(url):
+    """Lower case the scheme and host of ``url`` and drop its default port
+    and trailing slashes; anything that is not an absolute URL is kept."""
+    import urllib.parse
+
+    parts = urllib.parse.urlsplit(url)
+    if not (parts.scheme and parts.netloc):
+        return url
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.rpartition('@')
+    host = netloc[2].lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is not None and _DEFAULT_PORTS.get(scheme) == port:
+        host = host.rpartition(':')[0]
+    return urllib.parse.urlunsplit((
+        scheme, netloc[0] + netloc[1] + host, parts.path.rstrip('/'),
+        parts.query, parts.fragment))
+
+
+def _url_host(host):
+    """Bracket ``host`` for use in a URL if it is an IPv6 address."""
+    import ipaddress
+
+    if not isinstance(host, str) or ':' not in host:
+        return host
+    try:
+        ipaddress.IPv6Address(host)
+    except ValueError:
+        return host
+    return '[{}]'.format(host)
+
+
+def encode_service_endpoints(records):
+    """Canonical encoding of the keystone-k8s ``service-endpoints`` data.
+
+    Records are sorted by service name then type, their keys sorted, URLs
+    normalised and the JSON written without whitespace, so the same
+    endpoints always encode to the same document whatever order they were
+    given in.
+
+    :param records: dicts with 'service_name', 'type', 'description' and
+                    '*_url' keys
+    :type records: list[dict]
+    :returns: the document and its sha256 hex digest
+    :rtype: tuple(str, str)
+    """
+    import hashlib
+    import json
+
+    records = sorted(
+        ({key: _normalise_url(value) if key.endswith('_url') else value
+          for key, value in record.items()} for record in records),
+        key=lambda r: (r.get('service_name', ''), r.get('type', '')))
+    document = json.dumps(records, sort_keys=True, separators=(',', ':'))
+    return document, hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _crypto():
+    """The parts of the optional cryptography library used to validate SSL
+    material, imported on first use.
+
+    A warning is logged, once, when cryptography is not installed, as the
+    ``.valid`` flags are then never set.
+
+    :returns: the modules by name, or None if cryptography is not installed
+    :rtype: Optional[types.SimpleNamespace]
+    """
+    try:
+        from cryptography import x509
+        from cryptography.exceptions import (
+            InvalidSignature, UnsupportedAlgorithm)
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import (
+            ec, padding, rsa)
+    except ImportError:
+        hookenv.log('The cryptography library is not installed, SSL '
+                    'material sent by keystone cannot be validated',
+                    level=hookenv.WARNING)
+        return None
+    return types.SimpleNamespace(
+        x509=x509, InvalidSignature=InvalidSignature,
+        UnsupportedAlgorithm=UnsupportedAlgorithm,
+        serialization=serialization, ec=ec, padding=padding, rsa=rsa)
+
+
+def _load_certificates(data):
+    """Parse every certificate of a PEM bundle, in order."""
+    import re
+
+    x509 = _crypto().x509
+    return [x509.load_pem_x509_certificate(pem) for pem in re.findall(
+        b'-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----',
+        data, re.DOTALL)]
+
+
+def _public_bytes(public_key):
+    serialization = _crypto().serialization
+    return public_key.public_bytes(
+        serialization.Encoding.DER,
+        serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+def _issued_by(cert, issuer):
+    """Whether ``issuer`` signed ``cert``."""
+    if cert.issuer != issuer.subject:
+        return False
+    crypto = _crypto()
+    public_key = issuer.public_key()
+    try:
+        if isinstance(public_key, crypto.rsa.RSAPublicKey):
+            public_key.verify(cert.signature, cert.tbs_certificate_bytes,
+                              crypto.padding.PKCS1v15(),
+                              cert.signature_hash_algorithm)
+        elif isinstance(public_key, crypto.ec.EllipticCurvePublicKey):
+            public_key.verify(cert.signature, cert.tbs_certificate_bytes,
+                              crypto.ec.ECDSA(cert.signature_hash_algorithm))
+        else:
+            public_key.verify(cert.signature, cert.tbs_certificate_bytes)
+    except (crypto.InvalidSignature, crypto.UnsupportedAlgorithm,
+            TypeError, ValueError):
+        return False
+    return True
+
+
+def _chain(certs, cas):
+    """Certificates from ``certs[0]`` up to one signed by a CA of ``cas``.
+
+    The certificates following the first one in ``certs`` may be
+    intermediates.
+
+    :returns: the chain, or None when it does not lead to ``cas``
+    :rtype: Optional[list]
+    """
+    chain = [certs[0]]
+    intermediates = list(certs[1:])
+    while True:
+        if any(_issued_by(chain[-1], ca) for ca in cas):
+            return chain
+        issuer = next((cert for cert in intermediates
+                       if _issued_by(chain[-1], cert)), None)
+        if issuer is None:
+            return None
+        intermediates.remove(issuer)
+        chain.append(issuer)
+
+
+def _validity_period(certs):
+    """Period, as POSIX timestamps, in which all of ``certs`` are valid."""
+    import datetime
+
+    def _timestamp(cert, name):
+        value = getattr(cert, name + '_utc', None)
+        if value is None:
+            value = getattr(cert, name).replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    return {
+        'not_before': max(_timestamp(c, 'not_valid_before') for c in certs),
+        'not_after': min(_timestamp(c, 'not_valid_after') for c in certs),
+    }
+
+
+def _write_file_atomic(path, content, perms, uid=-1, gid=-1):
+    """Replace ``path`` with ``content`` unless it already holds it.
+
+    The content is written to a temporary file in the same directory,
+    which gets its permissions and ownership before being renamed over
+    ``path``, so readers never see a partial or world readable file.  A
+    file already holding ``content`` only gets its mode and ownership
+    corrected, which does not count as a write.
+
+    :param content: data to write
+    :type content: bytes
+    :param perms: mode of the file
+    :type perms: int
+    :param uid: owner of the file, -1 to keep the current user
+    :type uid: int
+    :param gid: group of the file, -1 to keep the current group
+    :type gid: int
+    :returns: whether the file was written
+    :rtype: bool
+    """
+    import hashlib
+    import tempfile
+
+    try:
+        with open(path, 'rb') as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(
+                    content).digest():
+                # same content, only bring the mode and ownership in line
+                st = os.fstat(f.fileno())
+                if st.st_mode & 0o7777 != perms:
+                    os.fchmod(f.fileno(), perms)
+                if uid not in (-1, st.st_uid) or gid not in (-1, st.st_gid):
+                    os.fchown(f.fileno(), uid, gid)
+                return False
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), perms)
+            if uid != -1 or gid != -1:
+                os.fchown(f.fileno(), uid, gid)
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+@functools.lru_cache(maxsize=32)
+def _decode_pem(value):
+    """Decode base64 encoded PEM material received from keystone.
+
+    Results are cached on the raw relation value, so a rotated
+    certificate simply misses the cache.  Only the bytes are kept, as DER
+    or other binary material does not decode to text.
+
+    :returns: decoded bytes
+    :rtype: bytes
+    """
+    import base64
+
+    return base64.b64decode(value)
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_checksums(value):
+    """Parse the JSON ``ep_changed`` notification sent by keystone.
+
+    :returns: endpoint->checksum data, or an empty mapping if the value is
+              not a JSON object
+    :rtype: types.MappingProxyType
+    """
+    import json
+
+    try:
+        checksums = json.loads(value)
+    except ValueError:
+        checksums = None
+    if not isinstance(checksums, dict):
+        checksums = {}
+    return types.MappingProxyType(checksums)
+
+
+def _digest(value):
+    """Stable sha256 digest of JSON serialisable relation data."""
+    import hashlib
+    import json
+
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _non_empty(value):
+    """Completeness rule: the field has a value."""
+    return bool(value)
+
+
+def _non_null(value):
+    """Completeness rule: the field has a value that is not the
+    ``'__null__'`` placeholder keystone sends for missing SSL data."""
+    return bool(value) and value != '__null__'
+
+
+def _masked(data, secrets):
+    """Copy relation data with the values of ``secrets`` keys digested.
+
+    Placeholders are kept so that completeness rules still apply to
+    recorded data.
+    """
+    return {key: ('sha256:' + _digest(value)[:12]
+                  if key in secrets and _non_null(value) else value)
+            for key, value in data.items()}
+
+
+class _ReceivedData(object):
+    """Immutable snapshot of the data received from keystone in one hook.
+
+    Both the application data and the unit data are only read the first
+    time they are needed, the unit data typically only when a field is
+    missing from the application data.  Once the protocol keystone speaks
+    on the relation is known ('app' for keystone-k8s, 'unit' for the
+    classic charm) the other bag is not read at all.
+
+    With ``markers``, the marker keys of each protocol, a protocol cached
+    from an earlier hook is only trusted while its own bag carries its
+    markers; otherwise both bags are read, as for an unknown protocol.
+    """
+
+    __slots__ = ('relation_id', 'protocol', '_app', '_load_app', '_units',
+                 '_load_units', '_markers')
+
+    def __init__(self, relation_id, load_app, load_units, protocol=None,
+                 markers=None):
+        self.relation_id = relation_id
+        self.protocol = protocol
+        self._app = None
+        self._load_app = load_app
+        self._units = None
+        self._load_units = load_units
+        self._markers = markers if protocol else None
+
+    def _check_protocol(self):
+        if self._markers is None:
+            return
+        markers, self._markers = self._markers[self.protocol], None
+        if self.protocol == 'app':
+            self._app = types.MappingProxyType(self._load_app())
+            bag = self._app
+        else:
+            self._units = types.MappingProxyType(self._load_units())
+            bag = self._units
+        if not any(bag.get(key) for key in markers):
+            self.protocol = None
+
+    @property
+    def app(self):
+        self._check_protocol()
+        if self._app is None:
+            self._app = types.MappingProxyType(
+                {} if self.protocol == 'unit' else self._load_app())
+        return self._app
+
+    @property
+    def units(self):
+        self._check_protocol()
+        if self._units is None:
+            self._units = types.MappingProxyType(
+                {} if self.protocol == 'app' else self._load_units())
+        return self._units
+
+    def set_protocol(self, protocol):
+        """Switch protocol, dropping whatever it shows or hides anew."""
+        self._markers = None
+        for attr, hidden_by in (('_app', 'unit'), ('_units', 'app')):
+            if (self.protocol == hidden_by) != (protocol == hidden_by):
+                setattr(self, attr, None)
+        self.protocol = protocol
+
+    def reset(self):
+        """Forget the data read so far."""
+        self._app = None
+        self._units = None
+
+    def read(self, bag):
+        """Read ``bag`` ('app' or 'unit') regardless of the protocol."""
+        if bag == 'app':
+            return self._load_app()
+        return self._load_units()
+
+    @property
+    def region(self):
+        """Region advertised by keystone on this relation, if any."""
+        return self.app.get('region') or self.units.get('region')
+
+
+class _ReceivedIndex(object):
+    """Per-hook index of the data received on each keystone relation.
+
+    ``default`` keeps the historic view of the endpoint: the application
+    data of the first relation with the unit data merged across all
+    relations.  ``by_relation_id`` holds one ``_ReceivedData`` per
+    relation, with unit data of that relation only, resolved from the
+    data of each unit according to ``policy``.  The data bags read are
+    counted as 'relation_get' in ``io_counts``.  The cached ``protocols``
+    are checked against ``markers``, see _ReceivedData.
+    """
+
+    def __init__(self, endpoint, protocols, policy='lowest', io_counts=None,
+                 markers=None):
+        relations = list(endpoint.relations)
+        self.policy = policy
+        self.io_counts = (collections.Counter() if io_counts is None
+                          else io_counts)
+        self._relations = {relation.relation_id: relation
+                           for relation in relations}
+        self._per_unit = {}
+        self.by_relation_id = collections.OrderedDict(
+            (relation.relation_id, _ReceivedData(
+                relation.relation_id,
+                functools.partial(self._app_data, relation),
+                functools.partial(self._resolved_units,
+                                  relation.relation_id),
+                protocols.get(relation.relation_id), markers))
+            for relation in relations)
+        first = None
+        if relations:
+            first = self.by_relation_id[relations[0].relation_id]
+        self.default = _ReceivedData(
+            first and first.relation_id,
+            lambda: dict(first.app) if first else {},
+            self._merged_units)
+        self._regions = {}
+
+    def per_unit(self, relation_id):
+        """Raw data of each unit joined on a relation, in unit name order.
+
+        :returns: unit name->data
+        :rtype: collections.OrderedDict
+        """
+        if relation_id not in self._per_unit:
+            self._per_unit[relation_id] = collections.OrderedDict(
+                (unit.unit_name,
+                 types.MappingProxyType(_as_dict(unit.received_raw)))
+                for unit in self._relations[relation_id].joined_units)
+            self.io_counts['relation_get'] += len(
+                self._per_unit[relation_id])
+        return self._per_unit[relation_id]
+
+    def _app_data(self, relation):
+        self.io_counts['relation_get'] += 1
+        return _as_dict(relation.received_app_raw)
+
+    def _resolved_units(self, relation_id):
+        # decode only the values that won, like CombinedUnitsView.received
+        return dict(JSONUnitDataView(
+            _resolve_units(self.per_unit(relation_id), self.policy)).items())
+
+    def _merged_units(self):
+        # Same precedence as CombinedUnitsView: lowest relation id first,
+        # built from the per relation snapshots so units are read once.
+        merged = {}
+        for relation_id in sorted(self.by_relation_id, reverse=True):
+            merged.update(self.by_relation_id[relation_id].units)
+        return merged
+
+    def set_protocols(self, protocols):
+        """Apply newly detected protocols to the snapshots of this hook."""
+        for relation_id, data in self.by_relation_id.items():
+            data.set_protocol(protocols.get(relation_id))
+        self.default.reset()
+
+    def for_region(self, region):
+        """Data of the first relation advertising ``region``, if any.
+
+        Relations are inspected in order and only until a match is found;
+        the result is remembered for the rest of the hook.
+        """
+        if region not in self._regions:
+            self._regions[region] = next(
+                (data for data in self.by_relation_id.values()
+                 if data.region == region), None)
+        return self._regions[region]
+
+
+def _resolve_units(per_unit, policy):
+    """Merge the data of the units of a relation into a single mapping.
+
+    With the 'lowest' policy the first unit providing a key wins, as in
+    ``CombinedUnitsView``.  With 'majority' the value provided by most
+    units wins, ties going to the value of the first unit.
+
+    :param per_unit: unit name->data, in unit name order
+    :type per_unit: collections.OrderedDict
+    :param policy: 'lowest' or 'majority'
+    :type policy: str
+    :rtype: dict
+    """
+    merged = {}
+    if policy != 'majority':
+        for data in reversed(list(per_unit.values())):
+            merged.update(data)
+        return merged
+    candidates = collections.defaultdict(collections.OrderedDict)
+    for data in per_unit.values():
+        for key, value in data.items():
+            votes = candidates[key].setdefault(_digest(value), [value, 0])
+            votes[1] += 1
+    for key, votes in candidates.items():
+        # max() keeps the first of equal counts, i.e. the first unit's
+        merged[key] = max(votes.values(), key=lambda vote: vote[1])[0]
+    return merged
+
+
+# Environment variable naming the file a cProfile report of the hook is
+# appended to, see KeystoneRequires._instrumentation()
+PROFILE_ENV = 'KEYSTONE_INTERFACE_PROFILE'
+
+
+def _instrumented(method):
+    """Run an endpoint method under KeystoneRequires._instrumentation().
+
+    Not for the reactive handlers: charms.reactive tells handlers apart by
+    the code object of the decorated function, which a wrapper shares, so
+    they use _instrumentation() in their body instead.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._instrumentation(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class KeystoneCredentials(object):
+    """Validated, immutable view of the credentials sent by keystone.
+
+    Ports and the API version are converted to ints and the service and
+    auth URLs are assembled once, so templates only read attributes.
+    """
+
+    __slots__ = (
+        'service_protocol', 'service_host', 'service_port',
+        'auth_protocol', 'auth_host', 'auth_port', 'api_version',
+        'service_username', 'service_password',
+        'service_tenant', 'service_tenant_id',
+        'service_domain', 'service_domain_id',
+        'admin_domain_id', 'admin_user_id', 'admin_project_id',
+        'auth_url', 'service_url',
+    )
+
+    def __init__(self, **fields):
+        """
+        :raises: ValueError if a port or the API version is not a number
+        """
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.get(name))
+        for name in ('service_port', 'auth_port'):
+            object.__setattr__(self, name, self._to_int(name))
+        # keystone sends '2' or '3', older releases '2.0'
+        api_version = fields.get('api_version')
+        if api_version:
+            api_version = int(float(api_version))
+        object.__setattr__(self, 'api_version', api_version)
+        object.__setattr__(self, 'auth_url', '{}://{}:{}'.format(
+            self.auth_protocol, _url_host(self.auth_host), self.auth_port))
+        object.__setattr__(self, 'service_url', '{}://{}:{}'.format(
+            self.service_protocol, _url_host(self.service_host),
+            self.service_port))
+
+    def _to_int(self, name):
+        value = getattr(self, name)
+        if value in (None, ''):
+            return None
+        return int(value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('KeystoneCredentials is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('KeystoneCredentials is immutable')
+
+    def __repr__(self):
+        return '<KeystoneCredentials {} as {}>'.format(
+            self.auth_url, self.service_username)
+
+
+FieldSpec = collections.namedtuple(
+    'FieldSpec', ('name', 'unit_key', 'app_key', 'type', 'tiers', 'secret'))
+FieldSpec.__doc__ = """Compiled description of an ``auto_accessors`` field.
+
+:param name: name of the generated accessor method
+:param unit_key: key in the unit data bag of the classic keystone charm
+:param app_key: key in the application data bag of keystone-k8s
+:param type: type the value represents once converted
+:param tiers: completeness tiers requiring the field
+:param secret: whether the value must not be logged or recorded
+"""
 
 
 # NOTE: fork of relations.AutoAccessors for forwards compat behaviour
@@ -22,33 +634,81 @@ class KeystoneAutoAccessors(type):
     """
     Metaclass that converts fields referenced by ``auto_accessors`` into
     accessor methods with very basic doc strings.
+
+    The accessors are only created, and then kept on the class, the first
+    time they are looked up, so loading the module for a hook that never
+    reads the relation does not build them.  They are listed by dir(), so
+    help() and other introspection still find them.
+
+    It also compiles ``auto_accessors``, ``_forward_compat_remaps``,
+    ``_field_types``, ``_secret_fields`` and ``completeness_tiers``, including
+    those inherited, into a read-only ``field_schema`` of ``FieldSpec`` keyed
+    by field, so subclasses only need to list what they add or change.
     """
 
     def __new__(cls, name, parents, dct):
-        for field in dct.get('auto_accessors', []):
-            meth_name = field.replace('-', '_')
-            meth = cls._accessor(field)
-            meth.__name__ = meth_name
-            meth.__module__ = dct.get('__module__')
-            meth.__doc__ = 'Get the %s, if available, or None.' % field
-            dct[meth_name] = meth
-        return super(KeystoneAutoAccessors, cls).__new__(
+        new_cls = super(KeystoneAutoAccessors, cls).__new__(
             cls, name, parents, dct
         )
+        new_cls.field_schema = cls._compile_schema(new_cls)
+        new_cls._accessor_fields = {spec.name: field for field, spec
+                                    in new_cls.field_schema.items()}
+        return new_cls
+
+    def __getattr__(cls, name):
+        # only reached when normal lookup failed, i.e. the accessor has not
+        # been created yet; vars() as the class may still be being built
+        field = vars(cls).get('_accessor_fields', {}).get(name)
+        if field is None:
+            raise AttributeError(
+                "type object '{}' has no attribute '{}'".format(
+                    cls.__name__, name))
+        meth = cls._accessor(field)
+        meth.__name__ = name
+        meth.__qualname__ = '{}.{}'.format(cls.__qualname__, name)
+        meth.__module__ = cls.__module__
+        meth.__doc__ = 'Get the %s, if available, or None.' % field
+        setattr(cls, name, meth)
+        return meth
+
+    def __dir__(cls):
+        return sorted(set(super(KeystoneAutoAccessors, cls).__dir__())
+                      | set(cls._accessor_fields))
+
+    @staticmethod
+    def _compile_schema(new_cls):
+        fields = []
+        for klass in reversed(new_cls.__mro__):
+            for field in vars(klass).get('auto_accessors', []):
+                if field not in fields:
+                    fields.append(field)
+        remaps = getattr(new_cls, '_forward_compat_remaps', {})
+        field_types = getattr(new_cls, '_field_types', {})
+        secrets = getattr(new_cls, '_secret_fields', frozenset())
+        tiers = collections.defaultdict(list)
+        for tier, (_, rules) in getattr(
+                new_cls, 'completeness_tiers', {}).items():
+            for meth_name in rules:
+                tiers[meth_name].append(tier)
+        schema = collections.OrderedDict()
+        for field in fields:
+            meth_name = field.replace('-', '_')
+            schema[field] = FieldSpec(
+                name=meth_name,
+                unit_key=field,
+                # Use remapped or transposed key for application
+                # data bag lookup for forwards compat
+                app_key=remaps.get(field, field.replace('_', '-')),
+                type=field_types.get(field, str),
+                tiers=tuple(tiers[meth_name]),
+                secret=field in secrets,
+            )
+        return types.MappingProxyType(schema)
 
     @staticmethod
     def _accessor(field):
         def _accessor_internal(self):
-            # Use remapped or transposed key for application
-            # data bag lookup for forwards compat
-            app_field = self._forward_compat_remaps.get(
-                field,
-                field.replace('_', '-')
-            )
-            return self.relations[0].received_app_raw.get(
-                app_field,
-                self.all_joined_units.received.get(field)
-            )
+            return self._read_field(self.field_schema[field])
         return _accessor_internal
 
 
@@ -97,94 +757,945 @@ class KeystoneRequires(reactive.Endpoint, metaclass=KeystoneAutoAccessors):
         'service_domain': 'service-domain-name',
     }
 
+    # Types and secrecy of the auto_accessors fields, see field_schema
+    _field_types = {
+        'service_port': int,
+        'auth_port': int,
+        'api_version': int,
+        'ep_changed': dict,
+    }
+    _secret_fields = frozenset((
+        'service_password',
+        'admin_token',
+        'ssl_key',
+        'ssl_key_admin',
+        'ssl_key_internal',
+        'ssl_key_public',
+    ))
+
+    # Completeness tiers evaluated by complete_tiers():
+    # tier -> (tier it builds on, {field: rule})
+    completeness_tiers = {
+        'base': (None, {
+            'service_host': _non_empty,
+            'service_protocol': _non_empty,
+            'service_port': _non_empty,
+            'auth_host': _non_empty,
+            'auth_protocol': _non_empty,
+            'auth_port': _non_empty,
+            'service_tenant': _non_empty,
+            'service_username': _non_empty,
+            'service_password': _non_empty,
+            'service_tenant_id': _non_empty,
+        }),
+        'ssl': ('base', {
+            'ssl_cert_admin': _non_null,
+            'ssl_cert_internal': _non_null,
+            'ssl_cert_public': _non_null,
+            'ssl_key_admin': _non_null,
+            'ssl_key_internal': _non_null,
+            'ssl_key_public': _non_null,
+            'ca_cert': _non_null,
+        }),
+        'ssl_legacy': ('base', {
+            'ssl_key': _non_null,
+            'ssl_cert': _non_null,
+            'ca_cert': _non_null,
+        }),
+    }
+
+    # Flags managed by update_flags() and the tier each of them requires
+    tier_flags = {
+        '{endpoint_name}.available': 'base',
+        '{endpoint_name}.available.auth': 'base',
+        '{endpoint_name}.available.ssl': 'ssl',
+        '{endpoint_name}.available.ssl_legacy': 'ssl_legacy',
+    }
+
+    # Flags set by update_flags() once a tier is complete and the SSL
+    # material of the listed names, and the CA, pass validate_ssl()
+    validated_flags = {
+        '{endpoint_name}.available.ssl.valid': (
+            'ssl', ('admin', 'internal', 'public')),
+        '{endpoint_name}.available.ssl_legacy.valid': (
+            'ssl_legacy', ('legacy',)),
+    }
+
+    # Field groups tracked across hooks by update_change_flags(), each
+    # raising {endpoint_name}.changed.<group> when its data changes
+    change_groups = {
+        'auth': (
+            'service_tenant', 'service_username', 'service_password',
+            'service_tenant_id', 'service_domain', 'service_domain_id',
+            'admin_domain_id', 'admin_user_id', 'admin_project_id',
+            'admin_token', 'api_version',
+        ),
+        'endpoints': (
+            'service_host', 'service_protocol', 'service_port',
+            'auth_host', 'auth_protocol', 'auth_port', 'https_keystone',
+            'public-auth-url', 'internal-auth-url', 'admin-auth-url',
+        ),
+        'ssl.admin': ('ssl_key_admin', 'ssl_cert_admin'),
+        'ssl.internal': ('ssl_key_internal', 'ssl_cert_internal'),
+        'ssl.public': ('ssl_key_public', 'ssl_cert_public'),
+        'ssl.legacy': ('ssl_key', 'ssl_cert'),
+        'ca': ('ca_cert',),
+        'endpoint_checksums': ('ep_changed',),
+    }
+
+    # Common names keystone sends SSL material for, see get_ssl_bundle()
+    ssl_cns = ('admin', 'internal', 'public')
+
+    # Keys identifying the protocol keystone speaks on a relation
+    _protocol_markers = {
+        'app': ('public-auth-url', 'internal-auth-url', 'admin-auth-url'),
+        'unit': ('service_host', 'auth_host'),
+    }
+
+    # Number of held transitions kept by damping_history()
+    _damping_history_size = 20
+
+    # Number of invocations per method kept by configure_instrumentation()
+    # and the upper bounds, in seconds, of the instrumentation_report()
+    # histogram buckets
+    _instrumentation_window = 100
+    _histogram_bounds = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+    # Keys every endpoint record passed to register_services() must have
+    _endpoint_keys = ('service', 'public_url', 'internal_url', 'admin_url')
+    # Keys published by register_endpoints() for a single endpoint
+    _single_endpoint_keys = _endpoint_keys + ('region',)
+
+    # Per-hook index of the received relation data, see _received_data()
+    _snapshot = None
+    _snapshot_context = None
+    # Relation the accessors of a view read from, see for_relation()
+    _selection = (None, None)
+    _read_only = False
+    # Accessor read instrumentation, see add_read_observer()
+    _read_counts = None
+    _read_observers = None
+    # Relation and flag I/O, see io_counts and configure_instrumentation()
+    _io_counts = None
+    _instrument_depth = 0
+    # Hook context and instrumentation setting read in it
+    _instrumentation_setting = None
+    # Hook context and data last seen complete served while flap damping
+    # holds the flags, see _held_data()
+    _held = None
+    # Credentials built from the snapshot, see credentials
+    _credentials = None
+    _credentials_snapshot = None
+
+    def __getattr__(self, name):
+        # generated accessors not looked up on the class yet, see
+        # KeystoneAutoAccessors
+        if name in type(self)._accessor_fields:
+            return getattr(type(self), name).__get__(self, type(self))
+        raise AttributeError(
+            "'{}' object has no attribute '{}'".format(
+                type(self).__name__, name))
+
+    def __dir__(self):
+        return sorted(set(super(KeystoneRequires, self).__dir__())
+                      | set(type(self)._accessor_fields))
+
+    def _hook_context(self):
+        """Identify the hook context the received data was read in.
+
+        :returns: juju context id and the ids of the current relations
+        :rtype: tuple
+        """
+        return (os.environ.get('JUJU_CONTEXT_ID'),
+                tuple(relation.relation_id for relation in self.relations))
+
+    # Unit state and flags are reached through these so that replay() can
+    # run the endpoint offline
+    def _kv(self):
+        return unitdata.kv()
+
+    def _is_flag_set(self, flag):
+        return reactive.is_flag_set(flag)
+
+    def _set_flag(self, flag):
+        self._check_writable()
+        self.io_counts['flag_writes'] += 1
+        reactive.set_flag(flag)
+
+    def _clear_flag(self, flag):
+        self._check_writable()
+        self.io_counts['flag_writes'] += 1
+        reactive.clear_flag(flag)
+
+    def _publish(self, bag, data):
+        self._check_writable()
+        changed = _publish_changes(bag, data)
+        if changed:
+            self.io_counts['relation_set'] += 1
+        return changed
+
+    @property
+    def io_counts(self):
+        """Relation data bags read and written, and flags written.
+
+        :returns: 'relation_get', 'relation_set' and 'flag_writes' counts
+        :rtype: collections.Counter
+        """
+        if self._io_counts is None:
+            self._io_counts = collections.Counter()
+        return self._io_counts
+
+    def _received_index(self):
+        """Index of the data received from keystone for this hook.
+
+        Relation data is read at most once per hook and kept as immutable
+        mappings, so the generated accessors do not walk the relation data
+        again.  The index is discarded when the hook context changes.
+
+        :rtype: _ReceivedIndex
+        """
+        context = self._hook_context()
+        if self._snapshot is None or self._snapshot_context != context:
+            self._snapshot = _ReceivedIndex(
+                self, self.relation_protocols(),
+                self._kv().get(self._divergence_policy_key, 'lowest'),
+                self.io_counts, self._protocol_markers)
+            self._snapshot_context = context
+        return self._snapshot
+
+    def _received_data(self):
+        """Snapshot of the data the accessors read.
+
+        While flap damping holds the flags, this is the data last seen
+        complete rather than the data received, see configure_damping().
+
+        :returns: snapshot of application and unit data
+        :rtype: _ReceivedData
+        """
+        if self._selection == (None, None):
+            held = self._held_data()
+            if held is not None:
+                return held
+        return self._live_data()
+
+    def _live_data(self):
+        """Snapshot of the data received on the keystone relation read from.
+
+        :returns: snapshot of application and unit data
+        :rtype: _ReceivedData
+        """
+        index = self._received_index()
+        relation_id, region = self._selection
+        if relation_id is not None:
+            data = index.by_relation_id.get(relation_id)
+        elif region is not None:
+            data = index.for_region(region)
+        else:
+            return index.default
+        return data or _ReceivedData(None, dict, dict)
+
+    def for_relation(self, relation_id=None, region=None):
+        """Read-only view of the endpoint reading from one keystone relation.
+
+        The relation is chosen by these rules, in order:
+
+        - with ``relation_id``, only that relation is used;
+        - with ``region``, the relation with the lowest id on which keystone
+          advertises that region is used;
+        - otherwise the application data of the first relation is used,
+          falling back to the unit data merged across all relations, as the
+          endpoint itself does.
+
+        The view offers the accessors, credentials and the get_ssl_*,
+        read_fields and validate_ssl methods, which return None when the
+        chosen relation does not exist.  It cannot set flags or publish
+        data, so the flags always follow the endpoint's own rules.
+
+        :param relation_id: id of the relation to read from
+        :type relation_id: Optional[str]
+        :param region: region advertised by keystone to read from
+        :type region: Optional[str]
+        :returns: the view
+        :rtype: KeystoneRequires
+        """
+        import copy
+
+        # the view shares the index of the current hook
+        self._received_index()
+        view = copy.copy(self)
+        view._selection = (relation_id, region)
+        view._read_only = True
+        view._credentials = view._credentials_snapshot = None
+        return view
+
+    def _check_writable(self):
+        if self._read_only:
+            raise RuntimeError(
+                'Views returned by for_relation() are read-only')
+
+    def relation_protocols(self):
+        """Protocol keystone was detected to speak on each relation
+
+        :returns: relation id->'app' (keystone-k8s) or 'unit' (classic
+                  keystone charm), for relations whose protocol is known
+        :rtype: dict
+        """
+        current = set(relation.relation_id for relation in self.relations)
+        return {relation_id: protocol for relation_id, protocol in
+                self._kv().get(self._protocols_key, {}).items()
+                if relation_id in current}
+
+    def detect_protocols(self):
+        """Detect, and remember, the protocol keystone speaks per relation.
+
+        A known protocol is kept as long as the bag it uses still carries
+        its marker keys; otherwise, or while unknown, both bags are
+        inspected.  Relations without any keystone data stay unknown and
+        are read from both bags.
+
+        :returns: relation id->protocol for relations whose protocol is known
+        :rtype: dict
+        """
+        known = self.relation_protocols()
+        detected = {}
+        for relation_id, data in self._received_index().by_relation_id.items():
+            protocol = known.get(relation_id)
+            if protocol and self._speaks(protocol, data):
+                detected[relation_id] = protocol
+                continue
+            for candidate in ('app', 'unit'):
+                if self._speaks(candidate, data, reread=bool(protocol)):
+                    detected[relation_id] = candidate
+                    break
+        if detected != known:
+            self._kv().set(self._protocols_key, detected)
+            self._received_index().set_protocols(detected)
+        return detected
+
+    def _speaks(self, protocol, data, reread=False):
+        """Whether ``data`` carries the marker keys of ``protocol``."""
+        if reread:
+            # the cached protocol hid this bag from the snapshot
+            bag = data.read(protocol)
+        else:
+            bag = data.app if protocol == 'app' else data.units
+        return any(bag.get(key) for key in self._protocol_markers[protocol])
+
+    @property
+    def _protocols_key(self):
+        return self.expand_name('{endpoint_name}.relation-protocols')
+
+    def configure_divergence_policy(self, policy):
+        """Choose how values that differ between keystone units resolve.
+
+        'lowest' (the default) takes the value of the first unit in unit
+        name order that provides the key, 'majority' the value provided
+        by most units.  The policy applies from the next hook.
+
+        :param policy: 'lowest' or 'majority'
+        :type policy: str
+        :raises: ValueError for an unknown policy
+        """
+        if policy not in ('lowest', 'majority'):
+            raise ValueError('Unknown divergence policy {}'.format(policy))
+        self._kv().set(self._divergence_policy_key, policy)
+
+    @property
+    def _divergence_policy_key(self):
+        return self.expand_name('{endpoint_name}.divergence-policy')
+
+    def divergence_report(self):
+        """Keys whose value differs between the units of a relation
+
+        Only the ``field_schema`` keys and the region are compared, so the
+        addresses juju sets for each unit are not reported, and only units
+        providing a key.  Values of secret fields are replaced by a digest.
+
+        :returns: relation id->key->unit name->value, for relations with
+                  diverging keys only
+        :rtype: dict
+        """
+        index = self._received_index()
+        keys = set(spec.unit_key for spec in self.field_schema.values())
+        keys.add('region')
+        report = {}
+        for relation_id in index.by_relation_id:
+            values = collections.defaultdict(dict)
+            for unit_name, data in index.per_unit(relation_id).items():
+                for key, value in data.items():
+                    if key in keys:
+                        values[key][unit_name] = value
+            diverging = {}
+            for key, by_unit in values.items():
+                if len(set(_digest(v) for v in by_unit.values())) < 2:
+                    continue
+                spec = self.field_schema.get(key)
+                if spec and spec.secret:
+                    by_unit = {unit_name: _digest(value)[:12]
+                               for unit_name, value in by_unit.items()}
+                diverging[key] = by_unit
+            if diverging:
+                report[relation_id] = diverging
+        return report
+
+    def relation_regions(self):
+        """Region advertised by keystone on each relation
+
+        :returns: relation id->region, None if no region was advertised
+        :rtype: dict
+        """
+        return {relation_id: data.region for relation_id, data in
+                self._received_index().by_relation_id.items()}
+
+    def _read_field(self, spec, data=None):
+        start = time.monotonic()
+        if data is None:
+            data = self._received_data()
+        if spec.app_key in data.app:
+            value, bag = data.app[spec.app_key], 'app'
+        else:
+            value, bag = data.units.get(spec.unit_key), 'unit'
+        self._record_read(spec.unit_key, bag, time.monotonic() - start)
+        return value
+
+    def read_fields(self, fields=None):
+        """Read several ``field_schema`` fields in one sweep.
+
+        :param fields: fields to read, all of them if None
+        :type fields: Optional[Iterable[str]]
+        :returns: field->value, None for fields keystone did not send
+        :rtype: dict
+        """
+        data = self._received_data()
+        if fields is None:
+            fields = self.field_schema
+        return {field: self._read_field(self.field_schema[field], data)
+                for field in fields}
+
+    @property
+    def read_counts(self):
+        """Number of accessor reads per field and data bag.
+
+        :returns: (field, bag)->count, bag being 'app' or 'unit'
+        :rtype: collections.Counter
+        """
+        if self._read_counts is None:
+            self._read_counts = collections.Counter()
+        return self._read_counts
+
+    def add_read_observer(self, callback):
+        """Register a callback run on every generated accessor read.
+
+        :param callback: called with the field name, the bag the value was
+                         looked up in ('app' or 'unit') and the time the
+                         read took in seconds
+        :type callback: Callable[[str, str, float], None]
+        """
+        if self._read_observers is None:
+            self._read_observers = []
+        self._read_observers.append(callback)
+
+    def remove_read_observer(self, callback):
+        """Unregister a callback added with add_read_observer."""
+        if self._read_observers and callback in self._read_observers:
+            self._read_observers.remove(callback)
+
+    def _record_read(self, field, bag, elapsed):
+        self.read_counts[(field, bag)] += 1
+        for callback in self._read_observers or []:
+            callback(field, bag, elapsed)
+
     @reactive.when('endpoint.{endpoint_name}.joined')
     def joined(self):
-        reactive.set_flag(self.expand_name('{endpoint_name}.connected'))
+        with self._instrumentation('joined'):
+            self._set_flag(self.expand_name('{endpoint_name}.connected'))
 
     @reactive.when('endpoint.{endpoint_name}.changed')
     def changed(self):
-        self.update_flags()
-        reactive.clear_flag(
-            self.expand_name(
-                'endpoint.{endpoint_name}.changed'))
+        with self._instrumentation('changed'):
+            self.update_flags()
+            self.update_change_flags()
+            self._record('changed')
+            self._clear_flag(
+                self.expand_name(
+                    'endpoint.{endpoint_name}.changed'))
 
+    @_instrumented
     def update_flags(self):
-        if self.base_data_complete():
-            reactive.set_flag(self.expand_name('{endpoint_name}.available'))
-            reactive.set_flag(
-                self.expand_name('{endpoint_name}.available.auth'))
-            if self.ssl_data_complete():
-                reactive.set_flag(
-                    self.expand_name('{endpoint_name}.available.ssl'))
-            else:
-                reactive.clear_flag(
-                    self.expand_name('{endpoint_name}.available.ssl'))
-            if self.ssl_data_complete_legacy():
-                reactive.set_flag(
-                    self.expand_name('{endpoint_name}.available.ssl_legacy'))
+        """Bring the ``tier_flags`` and ``validated_flags`` in line with
+        the received data.
+
+        Only flags whose state actually changes are set or cleared, so an
+        unchanged relation causes no flag writes.
+
+        :returns: flags that were set and flags that were cleared
+        :rtype: tuple(set[str], set[str])
+        """
+        self._check_writable()
+        self.detect_protocols()
+        self._damp()
+        complete = self.complete_tiers()
+        wanted_flags = {self.expand_name(flag): tier in complete
+                        for flag, tier in self.tier_flags.items()}
+        validation = None
+        for flag, (tier, names) in self.validated_flags.items():
+            wanted = False
+            if tier in complete:
+                if validation is None:
+                    validation = self.validate_ssl()
+                wanted = all(validation.get(name) == []
+                             for name in names + ('ca',))
+            wanted_flags[self.expand_name(flag)] = wanted
+        added = set()
+        removed = set()
+        for flag, wanted in wanted_flags.items():
+            if wanted == bool(self._is_flag_set(flag)):
+                continue
+            if wanted:
+                self._set_flag(flag)
+                added.add(flag)
             else:
-                reactive.clear_flag(
-                    self.expand_name('{endpoint_name}.available.ssl_legacy'))
-        else:
-            reactive.clear_flag(
-                self.expand_name('{endpoint_name}.available'))
-            reactive.clear_flag(
-                self.expand_name('{endpoint_name}.available.ssl'))
-            reactive.clear_flag(
-                self.expand_name('{endpoint_name}.available.ssl_legacy'))
-            reactive.clear_flag(
-                self.expand_name('{endpoint_name}.available.auth'))
+                self._clear_flag(flag)
+                removed.add(flag)
+        return added, removed
+
+    def configure_damping(self, hooks=None, seconds=None):
+        """Damp flapping of the available flags, off by default.
+
+        While enabled, the data last seen complete is kept in unitdata,
+        secrets included, and when the base data turns incomplete the
+        flags are held as long as the data still received is consistent
+        with it.  Meanwhile the accessors, credentials and SSL methods
+        serve the data last seen complete and no ``changed.*`` flag is
+        raised.  The flags are cleared once the data has stayed
+        incomplete for more than ``hooks`` hooks or ``seconds`` seconds,
+        whichever comes first, or as soon as it contradicts the last
+        complete data.  Held transitions are listed by damping_history().
+
+        Calling it without arguments disables damping.
+
+        :param hooks: number of incomplete hooks to hold the flags for
+        :type hooks: Optional[int]
+        :param seconds: time to hold the flags for
+        :type seconds: Optional[float]
+        """
+        config = None
+        if hooks is not None or seconds is not None:
+            config = {'hooks': hooks, 'seconds': seconds}
+        kv = self._kv()
+        kv.set(self._damping_key('config'), config)
+        if config is None:
+            kv.set(self._damping_key('state'), {})
+            self._held = None
+
+    def damping_history(self):
+        """Transitions held back by flap damping, oldest first
+
+        :returns: dicts with the 'time', the number of incomplete 'hooks'
+                  so far and the 'flags' held
+        :rtype: list[dict]
+        """
+        return self._kv().get(self._damping_key('history'), [])
+
+    def _damping_key(self, name):
+        return self.expand_name('{endpoint_name}.damping-' + name)
+
+    def _held_data(self):
+        """Data last seen complete, while flap damping holds the flags.
+
+        :returns: the data, or None when the flags are not held
+        :rtype: Optional[_ReceivedData]
+        """
+        context = self._hook_context()
+        if self._held is None or self._held[0] != context:
+            state = self._kv().get(self._damping_key('state')) or {}
+            snapshot = state.get('snapshot')
+            data = None
+            if state.get('hooks') and isinstance(snapshot, dict):
+                data = _ReceivedData(
+                    None, dict, functools.partial(dict, snapshot), 'unit')
+            self._held = (context, data)
+        return self._held[1]
+
+    def _damp(self):
+        """Decide whether flap damping holds the flags this hook.
+
+        :returns: flags the data received would have cleared
+        :rtype: set[str]
+        """
+        kv = self._kv()
+        config = kv.get(self._damping_key('config'))
+        if not config:
+            return set()
+        context = self._hook_context()
+        self._held = (context, None)
+        state_key = self._damping_key('state')
+        state = kv.get(state_key, {})
+        live = self._live_data()
+        received = {spec.name: self._read_field(spec, live)
+                    for spec in self.field_schema.values()}
+        complete = self._complete_tiers(received)
+        if 'base' in complete:
+            snapshot = {spec.unit_key: received[spec.name]
+                        for spec in self.field_schema.values()
+                        if received[spec.name] is not None}
+            if state != {'snapshot': snapshot}:
+                kv.set(state_key, {'snapshot': snapshot})
+            return set()
+        snapshot = state.get('snapshot')
+        if not snapshot:
+            return set()
+        now = time.time()
+        # update_flags() may run several times in a hook, count it once
+        marker = [context[0], list(context[1])]
+        counted = state.get('context') == marker
+        hooks = state.get('hooks', 0) + (0 if counted else 1)
+        since = state.get('since', now)
+        present = [spec for spec in self.field_schema.values()
+                   if spec.name in self.completeness_tiers['base'][1]
+                   and received[spec.name]]
+        consistent = present and all(
+            snapshot.get(spec.unit_key) == received[spec.name]
+            for spec in present)
+        expired = (
+            (config['hooks'] is not None and hooks > config['hooks'])
+            or (config['seconds'] is not None
+                and now - since > config['seconds']))
+        if not consistent or expired:
+            kv.set(state_key, {})
+            return set()
+        kv.set(state_key, dict(state, hooks=hooks, since=since,
+                               context=marker))
+        self._held = (context, _ReceivedData(
+            None, dict, functools.partial(dict, snapshot), 'unit'))
+        tiers = dict(self.tier_flags)
+        tiers.update((flag, tier) for flag, (tier, _)
+                     in self.validated_flags.items())
+        held = set()
+        for flag, tier in tiers.items():
+            flag = self.expand_name(flag)
+            if tier not in complete and self._is_flag_set(flag):
+                held.add(flag)
+        if held and not counted:
+            history = kv.get(self._damping_key('history'), [])
+            history.append(
+                {'time': now, 'hooks': hooks, 'flags': sorted(held)})
+            kv.set(self._damping_key('history'),
+                   history[-self._damping_history_size:])
+            hookenv.log('Holding {} while keystone data is incomplete'
+                        .format(', '.join(sorted(held))))
+        return held
 
     @reactive.when('endpoint.{endpoint_name}.departed')
     def departed(self):
-        self.update_flags()
-        reactive.clear_flag(
-            self.expand_name(
-                'endpoint.{endpoint_name}.departed'))
+        with self._instrumentation('departed'):
+            self.update_flags()
+            self.update_change_flags()
+            self._record('departed')
+            self._clear_flag(
+                self.expand_name(
+                    'endpoint.{endpoint_name}.departed'))
 
-    def base_data_complete(self):
-        data = {
-            'service_host': self.service_host(),
-            'service_protocol': self.service_protocol(),
-            'service_port': self.service_port(),
-            'auth_host': self.auth_host(),
-            'auth_protocol': self.auth_protocol(),
-            'auth_port': self.auth_port(),
-            'service_tenant': self.service_tenant(),
-            'service_username': self.service_username(),
-            'service_password': self.service_password(),
-            'service_tenant_id': self.service_tenant_id(),
-        }
-        if all(data.values()):
-            return True
-        return False
+    def configure_recording(self, path=None):
+        """Record the data received from keystone, off by default.
 
-    def ssl_data_complete(self):
-        data = {
-            'ssl_cert_admin': self.ssl_cert_admin(),
-            'ssl_cert_internal': self.ssl_cert_internal(),
-            'ssl_cert_public': self.ssl_cert_public(),
-            'ssl_key_admin': self.ssl_key_admin(),
-            'ssl_key_internal': self.ssl_key_internal(),
-            'ssl_key_public': self.ssl_key_public(),
-            'ca_cert': self.ca_cert(),
+        While enabled, the changed and departed handlers append one JSON
+        line to ``path`` with the application and unit data of every
+        relation, secret values replaced by a digest, and the flags set
+        once the hook was handled.  The file can be fed back through the
+        endpoint offline with replay().
+
+        Calling it without arguments disables recording.
+
+        :param path: file to append the recording to
+        :type path: Optional[str]
+        """
+        self._kv().set(self._recording_key, path)
+
+    @property
+    def _recording_key(self):
+        return self.expand_name('{endpoint_name}.recording')
+
+    def _watched_flags(self):
+        """Flags managed by update_flags() and update_change_flags()."""
+        return ([self.expand_name(flag) for flag in self.tier_flags]
+                + [self.expand_name(flag) for flag in self.validated_flags]
+                + [self.expand_name('{endpoint_name}.changed.' + group)
+                   for group in self.change_groups])
+
+    def _record(self, handler):
+        import json
+
+        path = self._kv().get(self._recording_key)
+        if not path:
+            return
+        secrets = set()
+        for spec in self.field_schema.values():
+            if spec.secret:
+                secrets.update((spec.unit_key, spec.app_key))
+        index = self._received_index()
+        relations = []
+        for relation_id, data in index.by_relation_id.items():
+            units = []
+            if data.protocol != 'app':
+                units = [[unit_name, _masked(unit_data, secrets)]
+                         for unit_name, unit_data
+                         in index.per_unit(relation_id).items()]
+            relations.append({'id': relation_id,
+                              'app': _masked(data.app, secrets),
+                              'units': units})
+        entry = {
+            'time': time.time(),
+            'hook': hookenv.hook_name(),
+            'handler': handler,
+            'relations': relations,
+            'flags': [flag for flag in self._watched_flags()
+                      if self._is_flag_set(flag)],
         }
-        for value in data.values():
-            if not value or value == '__null__':
+        try:
+            with open(path, 'a') as f:
+                f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        except OSError as e:
+            hookenv.log('Unable to record keystone relation data: {}'
+                        .format(e), level=hookenv.WARNING)
+
+    def configure_instrumentation(self, enabled=True):
+        """Time the handlers, update_flags() and register_endpoints().
+
+        While enabled, the wall time, relation data bags read and written
+        and flags written of the last ``_instrumentation_window``
+        invocations of each of them are kept in unitdata, see
+        instrumentation_report().  Off by default.
+
+        :param enabled: whether to record invocations
+        :type enabled: bool
+        """
+        self._kv().set(self._instrumentation_key, bool(enabled))
+        self._instrumentation_setting = (
+            os.environ.get('JUJU_CONTEXT_ID'), bool(enabled))
+
+    @property
+    def _instrumentation_key(self):
+        return self.expand_name('{endpoint_name}.instrumentation')
+
+    def _instrumentation_enabled(self):
+        # read once per hook, the handlers run on every relation event
+        context = os.environ.get('JUJU_CONTEXT_ID')
+        setting = self._instrumentation_setting
+        if setting is None or setting[0] != context:
+            setting = (context,
+                       bool(self._kv().get(self._instrumentation_key)))
+            self._instrumentation_setting = setting
+        return setting[1]
+
+    @contextlib.contextmanager
+    def _instrumentation(self, name):
+        """Time the enclosed block and count the relation and flag I/O it
+        does.
+
+        The block is only recorded, as ``name``, while
+        configure_instrumentation() is enabled.  Independently, when the
+        ``PROFILE_ENV`` environment variable names a file, the outermost
+        instrumented block is run under cProfile and its report appended to
+        that file.
+
+        :param name: name the invocation is reported under
+        :type name: str
+        """
+        profile = (os.environ.get(PROFILE_ENV)
+                   if not self._instrument_depth else None)
+        enabled = self._instrumentation_enabled()
+        if not (enabled or profile):
+            yield
+            return
+        before = dict(self.io_counts)
+        profiler = None
+        if profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        self._instrument_depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._instrument_depth -= 1
+            if profiler:
+                profiler.disable()
+            if enabled:
+                self._record_invocation(name, elapsed, before)
+            if profiler:
+                self._dump_profile(profile, name, profiler)
+
+    @property
+    def _invocations_key(self):
+        return self.expand_name('{endpoint_name}.instrumentation-samples')
+
+    def _record_invocation(self, name, elapsed, before):
+        kv = self._kv()
+        samples = kv.get(self._invocations_key, {})
+        recent = samples.get(name, [])
+        recent.append([elapsed] + [
+            self.io_counts[counter] - before.get(counter, 0)
+            for counter in ('relation_get', 'relation_set', 'flag_writes')])
+        samples[name] = recent[-self._instrumentation_window:]
+        kv.set(self._invocations_key, samples)
+
+    def _dump_profile(self, path, name, profiler):
+        import pstats
+
+        try:
+            with open(path, 'a') as f:
+                f.write('# {} {}\n'.format(hookenv.hook_name(), name))
+                stats = pstats.Stats(profiler, stream=f)
+                stats.sort_stats('cumulative').print_stats(30)
+        except OSError as e:
+            hookenv.log('Unable to write the profile of {}: {}'
+                        .format(name, e), level=hookenv.WARNING)
+
+    def instrumentation_report(self):
+        """Statistics of the recent invocations of the instrumented methods
+
+        :returns: method name->{'calls': number of invocations kept,
+                  'histogram': [upper bound in seconds, None for the last
+                  bucket, and count] pairs, 'max_seconds', 'mean_seconds'
+                  and the mean 'relation_get', 'relation_set' and
+                  'flag_writes' per call}
+        :rtype: dict
+        """
+        report = {}
+        for name, samples in self._kv().get(
+                self._invocations_key, {}).items():
+            if not samples:
+                continue
+            bounds = self._histogram_bounds + (None,)
+            histogram = collections.OrderedDict((b, 0) for b in bounds)
+            for sample in samples:
+                bound = next(b for b in bounds
+                             if b is None or sample[0] <= b)
+                histogram[bound] += 1
+            columns = list(zip(*samples))
+            report[name] = {
+                'calls': len(samples),
+                'histogram': [list(item) for item in histogram.items()],
+                'max_seconds': max(columns[0]),
+                'mean_seconds': sum(columns[0]) / len(samples),
+            }
+            for counter, column in zip(
+                    ('relation_get', 'relation_set', 'flag_writes'),
+                    columns[1:]):
+                report[name][counter] = sum(column) / len(samples)
+        return report
+
+    @property
+    def credentials(self):
+        """Credentials sent by keystone, built once per hook.
+
+        :returns: the credentials, or None while the base data is
+                  incomplete or invalid
+        :rtype: Optional[KeystoneCredentials]
+        """
+        snapshot = self._received_data()
+        if self._credentials_snapshot is not snapshot:
+            self._credentials = None
+            self._credentials_snapshot = snapshot
+            if self.base_data_complete():
+                fields = {name: getattr(self, name)()
+                          for name in KeystoneCredentials.__slots__
+                          if name not in ('auth_url', 'service_url')}
+                try:
+                    self._credentials = KeystoneCredentials(**fields)
+                except ValueError as e:
+                    hookenv.log('Invalid keystone credentials: {}'.format(e),
+                                level=hookenv.WARNING)
+        return self._credentials
+
+    def update_change_flags(self):
+        """Raise a flag for each field group whose data changed.
+
+        A digest of every group in ``change_groups`` is kept in unitdata
+        across hooks, and ``{endpoint_name}.changed.<group>`` is set for
+        the groups whose digest moved.  The flags are left for the
+        consuming charm to clear once it has acted on them.
+
+        :returns: the groups that changed
+        :rtype: set[str]
+        """
+        self._check_writable()
+        if self._held_data() is not None:
+            # the data received is incomplete while flap damping holds
+            return set()
+        kv = self._kv()
+        key = self.expand_name('{endpoint_name}.change-group-digests')
+        previous = kv.get(key, {})
+        live = self._live_data()
+        values = {field: self._read_field(self.field_schema[field], live)
+                  for field in set(field for fields
+                                   in self.change_groups.values()
+                                   for field in fields)}
+        digests = {}
+        changed = set()
+        for group, fields in self.change_groups.items():
+            digests[group] = _digest([values[field] for field in fields])
+            empty = not any(values[field] for field in fields)
+            if digests[group] != previous.get(group) and not (
+                    empty and group not in previous):
+                changed.add(group)
+                self._set_flag(self.expand_name(
+                    '{endpoint_name}.changed.' + group))
+        if digests != previous:
+            kv.set(key, digests)
+        return changed
+
+    def _tier_complete(self, tier, values):
+        """Check the fields of a single tier against their rules.
+
+        :param tier: name of the tier in ``completeness_tiers``
+        :type tier: str
+        :param values: field->value cache shared between tiers, filled in
+                       as accessors are called
+        :type values: dict
+        :rtype: bool
+        """
+        for field, rule in self.completeness_tiers[tier][1].items():
+            if field not in values:
+                values[field] = getattr(self, field)()
+            if not rule(values[field]):
                 return False
         return True
 
+    def complete_tiers(self):
+        """Evaluate every completeness tier in a single pass.
+
+        Each field is read at most once, and a tier is only complete when
+        the tier it builds on is complete too.
+
+        :returns: names of the complete tiers
+        :rtype: set[str]
+        """
+        return self._complete_tiers()
+
+    def _complete_tiers(self, values=None):
+        values = {} if values is None else dict(values)
+        complete = set()
+        for tier, (parent, _) in self.completeness_tiers.items():
+            if parent is not None and parent not in complete:
+                continue
+            if self._tier_complete(tier, values):
+                complete.add(tier)
+        return complete
+
+    def base_data_complete(self):
+        return self._tier_complete('base', {})
+
+    def ssl_data_complete(self):
+        return self._tier_complete('ssl', {})
+
     def ssl_data_complete_legacy(self):
-        data = {
-            'ssl_key': self.ssl_key(),
-            'ssl_cert': self.ssl_cert(),
-            'ca_cert': self.ca_cert(),
-        }
-        for value in data.values():
-            if not value or value == '__null__':
-                return False
-        return True
+        return self._tier_complete('ssl_legacy', {})
 
+    @_instrumented
     def register_endpoints(self, service, region, public_url, internal_url,
                            admin_url, requested_roles=None,
                            add_role_to_admin=None,
@@ -192,7 +1703,40 @@ class KeystoneRequires(reactive.Endpoint, metaclass=KeystoneAutoAccessors):
                            service_description=None):
         """
         Register this service with keystone
+
+        Only keys whose value differs from what is already published on a
+        relation are written, so repeated calls with the same endpoints do
+        not trigger relation-changed hooks on keystone.
+        """
+        self._register_endpoints(
+            self.relations, service, region, public_url, internal_url,
+            admin_url, requested_roles=requested_roles,
+            add_role_to_admin=add_role_to_admin, service_type=service_type,
+            service_description=service_description)
+
+    def register_regional_endpoints(self, endpoints):
         """
+        Register this service with a different payload per relation
+
+        :param endpoints: register_endpoints() keyword arguments keyed by
+                          relation id or by the region keystone advertises
+                          on the relation; relations matching neither are
+                          left untouched
+        :type endpoints: dict
+        """
+        index = self._received_index()
+        for relation in self.relations:
+            kwargs = endpoints.get(relation.relation_id)
+            if kwargs is None:
+                region = index.by_relation_id[relation.relation_id].region
+                kwargs = endpoints.get(region)
+            if kwargs is not None:
+                self._register_endpoints([relation], **kwargs)
+
+    def _register_endpoints(self, relations, service, region, public_url,
+                            internal_url, admin_url, requested_roles=None,
+                            add_role_to_admin=None, service_type=None,
+                            service_description=None):
         relation_info = {
             'service': service,
             'public_url': public_url,
@@ -200,34 +1744,120 @@ class KeystoneRequires(reactive.Endpoint, metaclass=KeystoneAutoAccessors):
             'admin_url': admin_url,
             'region': region,
         }
-        if requested_roles:
-            relation_info.update(
-                {'requested_roles': ','.join(requested_roles)})
-        if add_role_to_admin:
-            relation_info.update(
-                {'add_role_to_admin': ','.join(add_role_to_admin)})
+        relation_info.update(
+            self._role_info(requested_roles, add_role_to_admin))
+        for relation in relations:
+            self._publish(relation.to_publish_raw, relation_info)
+
+        # NOTE: forwards compatible data presentation for keystone-k8s
+        if service_type and service_description:
+            self._publish_service_endpoints(region, [{
+                'service': service,
+                'public_url': public_url,
+                'internal_url': internal_url,
+                'admin_url': admin_url,
+                'service_type': service_type,
+                'service_description': service_description,
+            }], relations)
+
+    def register_services(self, endpoints, region, requested_roles=None,
+                          add_role_to_admin=None):
+        """
+        Register several services with keystone in one go
+
+        Each record is published to the classic keystone charm using the
+        ``<service>_<key>`` relation keys it understands for multiple
+        endpoints, in a single write per relation which also clears the
+        keys of an earlier register_endpoints(), and to keystone-k8s as one
+        combined ``service-endpoints`` document.
+
+        :param endpoints: records with 'service', 'public_url',
+                          'internal_url' and 'admin_url' keys and, for
+                          keystone-k8s, 'service_type' and
+                          'service_description'
+        :type endpoints: list[dict]
+        :param region: region to register the endpoints in
+        :type region: str
+        :raises: ValueError if there are no records, a record is
+                 incomplete, a service name contains '_' or is registered
+                 twice
+        """
+        if not endpoints:
+            # publishing only the cleared single endpoint keys would
+            # unregister the service
+            raise ValueError('No endpoints to register')
+        # clear what register_endpoints() published, keystone only looks
+        # for the multiple endpoint keys without the 'service' key
+        relation_info = dict.fromkeys(self._single_endpoint_keys)
+        services = set()
+        for endpoint in endpoints:
+            missing = [key for key in self._endpoint_keys
+                       if not endpoint.get(key)]
+            if missing:
+                raise ValueError(
+                    'Endpoint {} is missing {}'.format(
+                        endpoint, ', '.join(missing)))
+            service = endpoint['service']
+            if '_' in service:
+                raise ValueError(
+                    "Service name '{}' must not contain '_'".format(service))
+            if service in services:
+                raise ValueError(
+                    "Service '{}' registered more than once".format(service))
+            services.add(service)
+            relation_info['{}_region'.format(service)] = region
+            for key in self._endpoint_keys:
+                relation_info['{}_{}'.format(service, key)] = endpoint[key]
+        relation_info.update(
+            self._role_info(requested_roles, add_role_to_admin))
         for relation in self.relations:
-            relation.to_publish_raw.update(relation_info)
+            self._publish(relation.to_publish_raw, relation_info)
 
         # NOTE: forwards compatible data presentation for keystone-k8s
-        if all((service_type,
-                service_description,
-                reactive.is_flag_set('leadership.is_leader'),)):
+        if all(endpoint.get('service_type')
+               and endpoint.get('service_description')
+               for endpoint in endpoints):
+            self._publish_service_endpoints(region, endpoints, self.relations)
+
+    @staticmethod
+    def _role_info(requested_roles, add_role_to_admin):
+        role_info = {}
+        if requested_roles:
+            role_info['requested_roles'] = ','.join(requested_roles)
+        if add_role_to_admin:
+            role_info['add_role_to_admin'] = ','.join(add_role_to_admin)
+        return role_info
+
+    def _publish_service_endpoints(self, region, endpoints, relations):
+        """Publish the keystone-k8s ``service-endpoints`` document.
+
+        The document is published with its ``service-endpoints-digest``,
+        and only compared and rewritten when that digest moved.
+        Application data can only be written by the leader, so this is a
+        no-op on other units.
+        """
+        if not endpoints or not self._is_flag_set('leadership.is_leader'):
+            return
+        document, digest = encode_service_endpoints([
+            {
+                'service_name': endpoint['service'],
+                'type': endpoint['service_type'],
+                'description': endpoint['service_description'],
+                'internal_url': endpoint['internal_url'],
+                'admin_url': endpoint['admin_url'],
+                'public_url': endpoint['public_url'],
+            }
+            for endpoint in endpoints
+        ])
+        for relation in relations:
+            bag = relation.to_publish_app_raw
             application_info = {
                 'region': region,
-                'service-endpoints': json.dumps([
-                    {
-                        'service_name': service,
-                        'type': service_type,
-                        'description': service_description,
-                        'internal_url': internal_url,
-                        'admin_url': admin_url,
-                        'public_url': public_url,
-                    }
-                ], sort_keys=True)
+                'service-endpoints-digest': digest,
             }
-            for relation in self.relations:
-                relation.to_publish_app_raw.update(application_info)
+            if bag.get('service-endpoints-digest') != digest:
+                application_info['service-endpoints'] = document
+            self._publish(bag, application_info)
 
     def request_keystone_endpoint_information(self):
         self.register_endpoints('None', 'None', 'None', 'None', 'None')
@@ -243,34 +1873,390 @@ class KeystoneRequires(reactive.Endpoint, metaclass=KeystoneAutoAccessors):
             "subscribe_ep_change": " ".join(services),
         }
         for relation in self.relations:
-            relation.to_publish_raw.update(relation_info)
+            self._publish(relation.to_publish_raw, relation_info)
+
+    @staticmethod
+    def _decoded(value, as_bytes):
+        if not value:
+            return value
+        data = _decode_pem(value)
+        return data if as_bytes else data.decode('utf-8')
 
-    def get_ssl_key(self, cn=None):
+    @staticmethod
+    def pem_cache_info():
+        """Hit, miss and size counters of the decoded PEM cache.
+
+        :rtype: functools._CacheInfo
+        """
+        return _decode_pem.cache_info()
+
+    def get_ssl_key(self, cn=None, as_bytes=False):
         relation_key = 'ssl_key_{}'.format(cn) if cn else 'ssl_key'
-        key = self.all_joined_units.received.get(relation_key)
-        if key:
-            key = base64.b64decode(key).decode('utf-8')
-        return key
+        return self._decoded(
+            self._received_data().units.get(relation_key), as_bytes)
 
-    def get_ssl_cert(self, cn=None):
+    def get_ssl_cert(self, cn=None, as_bytes=False):
         relation_key = 'ssl_cert_{}'.format(cn) if cn else 'ssl_cert'
-        cert = self.all_joined_units.received.get(relation_key)
-        if cert:
-            cert = base64.b64decode(cert).decode('utf-8')
-        return cert
+        return self._decoded(
+            self._received_data().units.get(relation_key), as_bytes)
+
+    def get_ssl_ca(self, cn=None, as_bytes=False):
+        ca_cert = self.ca_cert()
+        if not ca_cert:
+            return None
+        return self._decoded(ca_cert, as_bytes)
+
+    def get_ssl_bundle(self, as_bytes=False):
+        """Read all SSL material sent by keystone in one pass.
+
+        Entries that are missing or set to the ``'__null__'`` placeholder
+        are returned as None and their relation keys listed in 'missing'.
+
+        :returns: {'admin'|'internal'|'public'|'legacy': {'key': ...,
+                  'cert': ...}, 'ca': ..., 'missing': [relation keys]}
+        :rtype: dict
+        """
+        units = self._received_data().units
+        bundle = {'missing': []}
+
+        def _read(relation_key, value):
+            if not _non_null(value):
+                bundle['missing'].append(relation_key)
+                return None
+            return self._decoded(value, as_bytes)
+
+        for cn in self.ssl_cns + (None,):
+            entry = {}
+            for kind in ('key', 'cert'):
+                relation_key = ('ssl_{}_{}'.format(kind, cn) if cn
+                                else 'ssl_{}'.format(kind))
+                entry[kind] = _read(relation_key, units.get(relation_key))
+            bundle[cn or 'legacy'] = entry
+        bundle['ca'] = _read('ca_cert', self.ca_cert())
+        return bundle
+
+    def write_ssl_files(self, paths, ca_path=None, owner=None, group=None,
+                        key_perms=0o600, cert_perms=0o644):
+        """Write the SSL material sent by keystone, if it changed.
+
+        Each file is replaced atomically, and only when its content
+        differs from the decoded material, so services only need a restart
+        when the returned set is not empty.  Material keystone did not send
+        is left alone.
+
+        :param paths: {'admin'|'internal'|'public'|'legacy': {'key': path,
+                      'cert': path}}, either path being optional
+        :type paths: dict
+        :param ca_path: file to write the CA certificate to
+        :type ca_path: Optional[str]
+        :param owner: user to own the files, the current user if None
+        :type owner: Optional[str]
+        :param group: group to own the files, the current group if None
+        :type group: Optional[str]
+        :param key_perms: mode of the key files
+        :type key_perms: int
+        :param cert_perms: mode of the certificate and CA files
+        :type cert_perms: int
+        :returns: the paths that were written
+        :rtype: set[str]
+        """
+        import grp
+        import pwd
+
+        uid = pwd.getpwnam(owner).pw_uid if owner else -1
+        gid = grp.getgrnam(group).gr_gid if group else -1
+        bundle = self.get_ssl_bundle(as_bytes=True)
+        files = []
+        for cn, cn_paths in paths.items():
+            for kind, path in cn_paths.items():
+                files.append((path, bundle[cn][kind],
+                              key_perms if kind == 'key' else cert_perms))
+        if ca_path:
+            files.append((ca_path, bundle['ca'], cert_perms))
+        return set(path for path, content, perms in files
+                   if content is not None
+                   and _write_file_atomic(path, content, perms, uid, gid))
+
+    def validate_ssl(self):
+        """Validate the SSL material sent by keystone.
 
-    def get_ssl_ca(self, cn=None):
-        ca = None
-        if self.ca_cert():
-            ca = base64.b64decode(self.ca_cert()).decode('utf-8')
-        return ca
+        Each key/cert pair is checked for the key matching the certificate,
+        the certificate chaining to the CA keystone sent and being within
+        its validity period, and the CA for being within its own.
+
+        The signature checks are cached in unitdata by fingerprint of the
+        material, so each distinct pair is only checked once across hooks;
+        validity periods are checked on every call.  Without the
+        cryptography library nothing validates.
+
+        :returns: 'admin'|'internal'|'public'|'legacy'|'ca'->problems found,
+                  empty if valid, for the material keystone sent
+        :rtype: dict
+        """
+        units = self._received_data().units
+        ca = self.ca_cert()
+        material = {}
+        if _non_null(ca):
+            material['ca'] = (ca, None, None)
+        for cn in self.ssl_cns + (None,):
+            key = units.get('ssl_key_{}'.format(cn) if cn else 'ssl_key')
+            cert = units.get('ssl_cert_{}'.format(cn) if cn else 'ssl_cert')
+            if _non_null(key) and _non_null(cert):
+                material[cn or 'legacy'] = (ca, key, cert)
+        kv = self._kv()
+        cache = kv.get(self._ssl_validation_key, {})
+        checked = {}
+        results = {}
+        now = time.time()
+        for name, (ca, key, cert) in material.items():
+            fingerprint = _digest([ca, key, cert])
+            entry = cache.get(fingerprint)
+            if entry is None:
+                entry = self._check_ssl(ca, key, cert)
+            if entry.get('cacheable', True):
+                checked[fingerprint] = entry
+            errors = list(entry['errors'])
+            if entry.get('not_before') is not None and not (
+                    entry['not_before'] <= now <= entry['not_after']):
+                errors.append('certificate is not valid at this time')
+            results[name] = errors
+        # the cache follows the material of the endpoint, not of views
+        if checked != cache and not self._read_only:
+            kv.set(self._ssl_validation_key, checked)
+        return results
+
+    @property
+    def _ssl_validation_key(self):
+        return self.expand_name('{endpoint_name}.ssl-validation')
+
+    def _check_ssl(self, ca, key=None, cert=None):
+        """Check the CA, or a key/cert pair against it, see validate_ssl()
+
+        :returns: {'errors': [...], 'not_before': ts, 'not_after': ts} with
+                  the validity period shared by the certificates involved,
+                  and 'cacheable' False when nothing could be checked
+        :rtype: dict
+        """
+        crypto = _crypto()
+        if crypto is None:
+            return {'errors': ['the cryptography library is not available'],
+                    'cacheable': False}
+        if not _non_null(ca):
+            return {'errors': ['no CA certificate']}
+        certs = []
+        private_key = None
+        try:
+            cas = _load_certificates(self._decoded(ca, True))
+            if cert:
+                certs = _load_certificates(self._decoded(cert, True))
+                private_key = crypto.serialization.load_pem_private_key(
+                    self._decoded(key, True), password=None)
+        except (crypto.UnsupportedAlgorithm, TypeError, ValueError) as e:
+            return {'errors': ['invalid SSL material: {}'.format(e)]}
+        if not cas or (cert and not certs):
+            return {'errors': ['no certificate found']}
+        if private_key is None:
+            return dict(_validity_period(cas), errors=[])
+        errors = []
+        if (_public_bytes(private_key.public_key())
+                != _public_bytes(certs[0].public_key())):
+            errors.append('key does not match the certificate')
+        chain = _chain(certs, cas)
+        if chain is None:
+            errors.append('certificate does not chain to the CA')
+            chain = certs[:1]
+        return dict(_validity_period(chain), errors=errors)
 
     def endpoint_checksums(self):
         """Read any endpoint notification checksums from the interface
 
+        The classic keystone charm sends the checksums as JSON decoded unit
+        data, keystone-k8s as a raw JSON string, which is parsed once per
+        distinct value.
+
         :returns: endpoint->checksum data dictionary
         :rtype: dict
         """
-        if self.ep_changed():
-            return self.ep_changed()
-        return {}
+        checksums = self.ep_changed()
+        if not checksums:
+            return {}
+        if isinstance(checksums, str):
+            checksums = _parse_checksums(checksums)
+        return dict(checksums)
+
+    def changed_endpoints(self):
+        """Endpoints whose checksum moved since last acknowledged
+
+        :returns: endpoint->checksum data for the endpoints that changed
+                  since ack_endpoint_changes() was last called
+        :rtype: dict
+        """
+        acked = self._kv().get(self._checksums_key, {})
+        return {endpoint: checksum
+                for endpoint, checksum in self.endpoint_checksums().items()
+                if acked.get(endpoint) != checksum}
+
+    def ack_endpoint_changes(self, endpoints=None):
+        """Record that this unit acted on the current endpoint checksums
+
+        :param endpoints: endpoints to acknowledge, all if None
+        :type endpoints: Optional[Iterable[str]]
+        """
+        kv = self._kv()
+        acked = kv.get(self._checksums_key, {})
+        checksums = self.endpoint_checksums()
+        if endpoints is not None:
+            checksums = {endpoint: checksums[endpoint]
+                         for endpoint in endpoints if endpoint in checksums}
+        acked.update(checksums)
+        kv.set(self._checksums_key, acked)
+
+    @property
+    def _checksums_key(self):
+        return self.expand_name('{endpoint_name}.acked-endpoint-checksums')
+
+
+_ReplayUnit = collections.namedtuple('_ReplayUnit',
+                                     ('unit_name', 'received_raw'))
+
+
+class _ReplayRelation(object):
+    """Relation serving the data of one recorded relation, see replay()."""
+
+    def __init__(self, recorded):
+        self.relation_id = recorded['id']
+        self.received_app_raw = recorded['app']
+        self.joined_units = [_ReplayUnit(unit_name, data)
+                             for unit_name, data in recorded['units']]
+        self.to_publish_raw = {}
+        self.to_publish_app_raw = {}
+
+
+class _ReplayKV(dict):
+    """In memory stand-in for unitdata.kv()."""
+
+    def set(self, key, value):
+        self[key] = value
+
+
+@functools.lru_cache(maxsize=None)
+def _stand_in(endpoint_class):
+    """Subclass of ``endpoint_class`` running without a juju model.
+
+    It is built on demand rather than at module level, where
+    charms.reactive would take it for the endpoint implementation.
+    """
+    class StandIn(endpoint_class):
+
+        def __init__(self, endpoint_name, relations, flags, kv):
+            super(StandIn, self).__init__(endpoint_name, [])
+            self._relations = [_ReplayRelation(relation)
+                               for relation in relations]
+            self._flags = flags
+            self._store = kv
+
+        def _kv(self):
+            return self._store
+
+        def _is_flag_set(self, flag):
+            return flag in self._flags
+
+        def _set_flag(self, flag):
+            self._flags.add(flag)
+
+        def _clear_flag(self, flag):
+            self._flags.discard(flag)
+
+    StandIn.__name__ = 'StandIn' + endpoint_class.__name__
+    return StandIn
+
+
+def replay(path, endpoint_name='identity-service', endpoint_class=None):
+    """Feed a recording made with configure_recording() through the
+    endpoint, offline.
+
+    Every recorded hook runs its handler on a new stand-in endpoint serving
+    the recorded data, with flags and unit state kept in memory across the
+    hooks.  Secret values are replayed as the digests recorded.
+
+    The ``changed.*`` flags are cleared before each hook, as the consuming
+    charm would once it acted on them.  Only the ``tier_flags`` are
+    compared with those recorded: when the consuming charm clears the
+    change flags is not recorded, and the SSL material cannot be validated
+    from its digests.
+
+    :param path: recording to replay
+    :type path: str
+    :param endpoint_name: name the recording was made under
+    :type endpoint_name: str
+    :param endpoint_class: endpoint to replay through, KeystoneRequires if
+                           None
+    :type endpoint_class: Optional[type]
+    :returns: a dict per hook with its 'step', 'hook', 'handler', the
+              'seconds' the handler took, the flags it 'set' and
+              'cleared', and the compared 'flags' set afterwards and those
+              'recorded'
+    :rtype: list[dict]
+    """
+    import json
+
+    endpoint_class = _stand_in(endpoint_class or KeystoneRequires)
+    flags = set()
+    kv = _ReplayKV()
+    steps = []
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    for step, entry in enumerate(entries, 1):
+        endpoint = endpoint_class(
+            endpoint_name, entry['relations'], flags, kv)
+        flags.difference_update(
+            endpoint.expand_name('{endpoint_name}.changed.' + group)
+            for group in endpoint.change_groups)
+        compared = [endpoint.expand_name(flag)
+                    for flag in endpoint.tier_flags]
+        before = set(flags)
+        flags.add(endpoint.expand_name(
+            'endpoint.{endpoint_name}.' + entry['handler']))
+        start = time.perf_counter()
+        getattr(endpoint, entry['handler'])()
+        elapsed = time.perf_counter() - start
+        steps.append({
+            'step': step,
+            'hook': entry['hook'],
+            'handler': entry['handler'],
+            'seconds': elapsed,
+            'set': sorted(flags - before),
+            'cleared': sorted(before - flags),
+            'flags': [flag for flag in compared if flag in flags],
+            'recorded': [flag for flag in compared
+                         if flag in entry['flags']],
+        })
+    return steps
+
+
+def main(argv=None):
+    """Replay a recording and print timing and flag transitions per hook.
+
+    Lines where the compared flags differ from those recorded are marked
+    with '!', see replay().
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Replay keystone relation data recorded by '
+                    'KeystoneRequires.configure_recording().')
+    parser.add_argument('recording')
+    parser.add_argument('--endpoint-name', default='identity-service')
+    args = parser.parse_args(argv)
+    for step in replay(args.recording, args.endpoint_name):
+        transitions = (['+' + flag for flag in step['set']]
+                       + ['-' + flag for flag in step['cleared']])
+        print('{}{:>4} {} {} {:.6f}s {}'.format(
+            ' ' if step['flags'] == step['recorded'] else '!',
+            step['step'], step['hook'], step['handler'], step['seconds'],
+            ' '.join(transitions)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
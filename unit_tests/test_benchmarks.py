@@ -0,0 +1,329 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the KeystoneRequires hot paths.
+
+The relations are built locally from plain objects, from a single keystone
+unit up to hundreds of units on several relations, and every operation
+records its time per call and the number of relation data reads and writes
+it caused.
+
+Set KEYSTONE_BENCH_OUTPUT to a file name to save the results as JSON, and
+KEYSTONE_BENCH_BASELINE to a previously saved file to fail on operations
+that got slower than KEYSTONE_BENCH_THRESHOLD (default 0.5, i.e. 50%).
+"""
+
+import base64
+import importlib.util
+import json
+import os
+import time
+import unittest
+
+from unittest import mock
+
+import requires
+
+from charms.reactive.endpoints import CombinedUnitsView
+
+# (number of relations, keystone units per relation)
+SCALES = [(1, 1), (1, 10), (1, 100), (3, 100)]
+ITERATIONS = 5
+
+PEM = base64.b64encode(
+    b'-----BEGIN CERTIFICATE-----\n'
+    + b'A' * 2048
+    + b'\n-----END CERTIFICATE-----\n').decode('utf-8')
+
+UNIT_DATA = {
+    'service_host': 'keystone.example.com',
+    'service_protocol': 'https',
+    'service_port': '5000',
+    'auth_host': 'keystone.example.com',
+    'auth_protocol': 'https',
+    'auth_port': '35357',
+    'service_tenant': 'services',
+    'service_username': 'cinder',
+    'service_password': 'password',
+    'service_tenant_id': 'f2e9a2ba1d4c4ee6a2e5c2a6d4c2b1f0',
+    'api_version': '3',
+    'ca_cert': PEM,
+    'ssl_key': PEM,
+    'ssl_cert': PEM,
+    'ssl_key_admin': PEM,
+    'ssl_cert_admin': PEM,
+    'ssl_key_internal': PEM,
+    'ssl_cert_internal': PEM,
+    'ssl_key_public': PEM,
+    'ssl_cert_public': PEM,
+    'ep_changed': json.dumps({'cinder': 'abcdef', 'nova': '123456'}),
+}
+
+APP_DATA = {
+    'auth-host': 'keystone.example.com',
+    'auth-port': '5000',
+    'auth-protocol': 'https',
+    'service-host': 'keystone.example.com',
+    'service-port': '5000',
+    'service-protocol': 'https',
+    'service-project-name': 'services',
+    'service-project-id': 'f2e9a2ba1d4c4ee6a2e5c2a6d4c2b1f0',
+    'service-user-name': 'cinder',
+    'service-password': 'password',
+    'api-version': '3',
+    'public-auth-url': 'https://keystone.example.com:5000/v3',
+    'internal-auth-url': 'https://keystone.example.com:5000/v3',
+    'admin-auth-url': 'https://keystone.example.com:35357/v3',
+}
+
+
+class Counters(object):
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+
+
+class FakeKV(dict):
+    """unitdata.kv() stand-in that persists across the hooks of a run."""
+
+    def set(self, key, value):
+        self[key] = value
+
+
+class FakeBag(dict):
+    """Published relation data bag counting the keys written."""
+
+    def __init__(self, counters):
+        super(FakeBag, self).__init__()
+        self._counters = counters
+
+    def __setitem__(self, key, value):
+        self._counters.writes += 1
+        super(FakeBag, self).__setitem__(key, value)
+
+    def update(self, data):
+        self._counters.writes += len(data)
+        super(FakeBag, self).update(data)
+
+
+class FakeUnit(object):
+
+    def __init__(self, relation, unit_name, data, counters):
+        self.relation = relation
+        self.unit_name = unit_name
+        self._data = data
+        self._counters = counters
+
+    @property
+    def received_raw(self):
+        self._counters.reads += 1
+        return self._data
+
+
+class FakeRelation(object):
+
+    def __init__(self, relation_id, units, app_data, counters, region=None):
+        self.relation_id = relation_id
+        self.application_name = 'keystone'
+        self._app_data = app_data
+        self._counters = counters
+        data = dict(UNIT_DATA, region=region) if region else UNIT_DATA
+        self.units = CombinedUnitsView([
+            FakeUnit(self, 'keystone/{}'.format(i), data, counters)
+            for i in range(units)])
+        self.joined_units = self.units
+        self.to_publish_raw = FakeBag(counters)
+        self.to_publish_app_raw = FakeBag(counters)
+
+    @property
+    def received_app_raw(self):
+        self._counters.reads += 1
+        return self._app_data
+
+
+def make_endpoint(relations, units, app_data=None):
+    """Build a KeystoneRequires as it would be at the start of a hook."""
+    counters = Counters()
+    endpoint = requires.KeystoneRequires('identity-service', [])
+    endpoint._relations = [
+        FakeRelation('identity-service:{}'.format(i), units,
+                     app_data or {}, counters, 'Region{}'.format(i))
+        for i in range(relations)]
+    return endpoint, counters
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    results = {}
+
+    def setUp(self):
+        flags = set()
+        patches = [
+            mock.patch.object(requires.reactive, 'is_flag_set',
+                              side_effect=lambda f: f in flags),
+            mock.patch.object(requires.reactive, 'set_flag',
+                              side_effect=flags.add),
+            mock.patch.object(requires.reactive, 'clear_flag',
+                              side_effect=flags.discard),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.flags = flags
+
+    @classmethod
+    def tearDownClass(cls):
+        output = os.environ.get('KEYSTONE_BENCH_OUTPUT')
+        if output:
+            with open(output, 'w') as f:
+                json.dump(cls.results, f, indent=2, sort_keys=True)
+
+    def measure(self, name, relations, units, operation, app_data=None):
+        """Time ``operation(endpoint)`` on a fresh endpoint per hook.
+
+        The unit's kv store is kept across the hooks of a run, so the
+        reads and writes reported are those of the last, steady state,
+        hook.
+
+        :returns: the reads and writes caused by a single call
+        :rtype: tuple(int, int)
+        """
+        best = None
+        kv = FakeKV()
+        for i in range(ITERATIONS):
+            endpoint, counters = make_endpoint(relations, units, app_data)
+            with mock.patch.object(requires.unitdata, 'kv', return_value=kv):
+                with mock.patch.dict(os.environ, {
+                        'JUJU_CONTEXT_ID': 'bench-{}'.format(i)}):
+                    start = time.perf_counter()
+                    operation(endpoint)
+                    elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        key = '{}[{}x{}]'.format(name, relations, units)
+        self.results[key] = {
+            'seconds': best,
+            'reads': counters.reads,
+            'writes': counters.writes,
+        }
+        self.check_baseline(key, best)
+        return counters.reads, counters.writes
+
+    def check_baseline(self, key, seconds):
+        baseline = os.environ.get('KEYSTONE_BENCH_BASELINE')
+        if not baseline:
+            return
+        with open(baseline) as f:
+            previous = json.load(f).get(key)
+        if not previous:
+            return
+        threshold = float(os.environ.get('KEYSTONE_BENCH_THRESHOLD', '0.5'))
+        limit = previous['seconds'] * (1 + threshold)
+        self.assertLessEqual(
+            seconds, limit,
+            '{} took {:.6f}s, baseline {:.6f}s'.format(
+                key, seconds, previous['seconds']))
+
+    def test_import(self):
+        """Load requires.py as charms.reactive does at every hook."""
+        spec = importlib.util.find_spec('requires')
+        best = None
+        for i in range(ITERATIONS):
+            module = importlib.util.module_from_spec(spec)
+            start = time.perf_counter()
+            spec.loader.exec_module(module)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.results['import'] = {'seconds': best, 'reads': 0, 'writes': 0}
+        self.check_baseline('import', best)
+        # nothing is built or imported for the accessors until used
+        endpoint_class = module.KeystoneRequires
+        self.assertFalse(set(vars(endpoint_class))
+                         & set(endpoint_class._accessor_fields))
+        for name in ('json', 'base64', 'hashlib', 'x509'):
+            self.assertNotIn(name, vars(module))
+        self.assertIn('service_host', dir(endpoint_class))
+
+    def test_update_flags(self):
+        for relations, units in SCALES:
+            reads, writes = self.measure(
+                'update_flags', relations, units,
+                lambda ep: ep.update_flags())
+            # classic keystone: one pass over the unit bags, no app bags
+            self.assertLessEqual(reads, relations * units)
+            self.assertEqual(writes, 0)
+            reads, _ = self.measure(
+                'update_flags_app', relations, units,
+                lambda ep: ep.update_flags(), app_data=APP_DATA)
+            # keystone-k8s: the app bags only
+            self.assertLessEqual(reads, relations)
+
+    def test_accessors(self):
+        def read_all(endpoint):
+            for field in requires.KeystoneRequires.auto_accessors:
+                getattr(endpoint, field.replace('-', '_'))()
+
+        for relations, units in SCALES:
+            reads, writes = self.measure(
+                'accessors', relations, units, read_all)
+            self.assertLessEqual(reads, 1 + relations * units)
+            self.assertEqual(writes, 0)
+
+    def test_accessors_by_region(self):
+        def read_region(endpoint):
+            view = endpoint.for_relation(region='Region0')
+            for field in requires.KeystoneRequires.auto_accessors:
+                getattr(view, field.replace('-', '_'))()
+
+        for relations, units in SCALES:
+            reads, _ = self.measure(
+                'accessors_by_region', relations, units, read_region)
+            # every app bag and the unit bags of the first relation
+            self.assertLessEqual(reads, relations + units)
+
+    def test_register_endpoints(self):
+        def register(endpoint):
+            for _ in range(2):
+                endpoint.register_endpoints(
+                    'cinderv3', 'RegionOne', 'https://public:8776',
+                    'https://internal:8776', 'https://admin:8776',
+                    service_type='volumev3',
+                    service_description='Cinder Volume Service v3')
+
+        for relations, units in SCALES:
+            for leader in (True, False):
+                self.flags.clear()
+                if leader:
+                    self.flags.add('leadership.is_leader')
+                name = 'register_endpoints_{}'.format(
+                    'leader' if leader else 'non_leader')
+                _, writes = self.measure(name, relations, units, register)
+                # the second, identical, registration writes nothing
+                self.assertEqual(writes, relations * (8 if leader else 5))
+
+    def test_get_ssl(self):
+        def get_ssl(endpoint):
+            for cn in ('admin', 'internal', 'public', None):
+                endpoint.get_ssl_key(cn)
+                endpoint.get_ssl_cert(cn)
+            endpoint.get_ssl_ca()
+
+        for relations, units in SCALES:
+            reads, _ = self.measure('get_ssl', relations, units, get_ssl)
+            self.assertLessEqual(reads, 1 + relations * units)
+
+    def test_endpoint_checksums(self):
+        for relations, units in SCALES:
+            reads, _ = self.measure(
+                'endpoint_checksums', relations, units,
+                lambda ep: ep.endpoint_checksums())
+            self.assertLessEqual(reads, 1 + relations * units)
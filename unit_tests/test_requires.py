@@ -10,7 +10,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import datetime
+import hashlib
+import importlib.util
 import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
 
 from unittest import mock
 
@@ -50,12 +59,52 @@ IDENTITY_APP_DATA = {
 }
 
 
+def _juju_keys(unit):
+    """Keys juju sets in the data of each unit."""
+    address = '10.0.0.{}'.format(unit + 10)
+    return {'private-address': address, 'ingress-address': address,
+            'egress-subnets': address + '/32'}
+
+
+def _make_cert(name, key, issuer_key=None, issuer_name=None, days=30,
+               offset=-1):
+    """Self-signed, or issued, PEM certificate for tests."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    subject = x509.Name([x509.NameAttribute(
+        x509.oid.NameOID.COMMON_NAME, name)])
+    start = datetime.datetime.now(datetime.timezone.utc) + \
+        datetime.timedelta(days=offset)
+    cert = x509.CertificateBuilder().subject_name(subject).issuer_name(
+        issuer_name or subject).public_key(key.public_key()).serial_number(
+        x509.random_serial_number()).not_valid_before(start).not_valid_after(
+        start + datetime.timedelta(days=days)).sign(
+        issuer_key or key, hashes.SHA256())
+    return cert.public_bytes(serialization.Encoding.PEM), subject
+
+
+def _key_pem(key):
+    from cryptography.hazmat.primitives import serialization
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption())
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('utf-8')
+
+
 class TestKeystoneRequires(test_utils.PatchHelper):
 
     def setUp(self):
         self.target = requires.KeystoneRequires('some-relation', [])
         self._patches = {}
         self._patches_start = {}
+        self._hooks = 0
+        environ = mock.patch.dict(os.environ, {'JUJU_CONTEXT_ID': 'hook-0'})
+        environ.start()
+        self.addCleanup(environ.stop)
 
     def tearDown(self):
         self.target = None
@@ -79,13 +128,16 @@ class TestKeystoneRequires(test_utils.PatchHelper):
         self.set_flag.assert_called_once_with('some-relation.connected')
 
     def test_departed(self):
+        self._patch_kv()
         self.patch_object(requires.reactive, 'clear_flag')
         self.patch_target('update_flags')
+        self.patch_target('update_change_flags')
         self.target.departed()
         self.clear_flag.assert_has_calls([
             mock.call('endpoint.some-relation.departed')
         ])
         self.update_flags.assert_called_once_with()
+        self.update_change_flags.assert_called_once_with()
 
     def test_base_data_complete(self):
         self.patch_target('service_host', '2')
@@ -105,9 +157,7 @@ class TestKeystoneRequires(test_utils.PatchHelper):
 
     def test_app_data_complete(self):
         relation = mock.MagicMock()
-        relation.received_app_raw.get.side_effect = (
-            lambda k, d: IDENTITY_APP_DATA.get(k, d)
-        )
+        relation.received_app_raw = IDENTITY_APP_DATA
         self.target._relations = [relation]
         self.assertEqual(self.target.service_host(), 'servicehost')
         self.assertEqual(self.target.auth_host(), 'authhost')
@@ -122,6 +172,327 @@ class TestKeystoneRequires(test_utils.PatchHelper):
         self.assertFalse(self.target.ssl_data_complete())
         self.assertFalse(self.target.ssl_data_complete_legacy())
 
+    def test_field_schema(self):
+        schema = requires.KeystoneRequires.field_schema
+        self.assertEqual(len(schema),
+                         len(requires.KeystoneRequires.auto_accessors))
+        self.assertEqual(schema['service_tenant'], requires.FieldSpec(
+            name='service_tenant', unit_key='service_tenant',
+            app_key='service-project-name', type=str, tiers=('base',),
+            secret=False))
+        self.assertEqual(schema['auth_port'].type, int)
+        self.assertEqual(schema['ca_cert'].tiers, ('ssl', 'ssl_legacy'))
+        self.assertTrue(schema['ssl_key_public'].secret)
+        self.assertEqual(schema['public-auth-url'].name, 'public_auth_url')
+        with self.assertRaises(TypeError):
+            schema['ca_cert'] = None
+
+    def test_field_schema_subclass(self):
+        class Extended(requires.KeystoneRequires):
+            auto_accessors = ['service_region']
+            _forward_compat_remaps = dict(
+                requires.KeystoneRequires._forward_compat_remaps,
+                service_region='region')
+
+        schema = Extended.field_schema
+        self.assertEqual(list(schema)[-1], 'service_region')
+        self.assertEqual(schema['service_region'].app_key, 'region')
+        self.assertEqual(
+            schema['service_host'],
+            requires.KeystoneRequires.field_schema['service_host'])
+        relation = mock.MagicMock()
+        relation.received_app_raw = {'region': 'RegionOne'}
+        target = Extended('some-relation', [])
+        target._relations = [relation]
+        self.assertEqual(target.service_region(), 'RegionOne')
+        self.assertEqual(target.read_fields(['service_region', 'ssl_key']),
+                         {'service_region': 'RegionOne', 'ssl_key': None})
+
+    def test_received_data_snapshot(self):
+        relation = mock.MagicMock()
+        app_raw = mock.PropertyMock(return_value=IDENTITY_APP_DATA)
+        type(relation).received_app_raw = app_raw
+        self.target._relations = [relation]
+        self.joined_units = self._joined_units(
+            relation, {'ssl_key': 'key', 'service_host': 'unithost'})
+        with mock.patch.dict(requires.os.environ,
+                             {'JUJU_CONTEXT_ID': 'ctx-1'}):
+            self.target.complete_tiers()
+            self.assertEqual(self.target.service_host(), 'servicehost')
+            self.assertEqual(self.target.ssl_key(), 'key')
+            self.assertIsNone(self.target.ssl_cert())
+            self.assertEqual(app_raw.call_count, 1)
+            self.assertEqual(self.joined_units.call_count, 1)
+            with self.assertRaises(TypeError):
+                self.target._received_data().app['service-host'] = 'x'
+        with mock.patch.dict(requires.os.environ,
+                             {'JUJU_CONTEXT_ID': 'ctx-2'}):
+            self.target.ssl_key()
+            self.assertEqual(app_raw.call_count, 2)
+            self.assertEqual(self.joined_units.call_count, 2)
+
+    def test_accessor_lazy_unit_fallback(self):
+        relation = mock.MagicMock()
+        relation.received_app_raw = IDENTITY_APP_DATA
+        self.target._relations = [relation]
+        self.joined_units = self._joined_units(relation, {'ssl_key': 'key'})
+        observer = mock.MagicMock()
+        self.target.add_read_observer(observer)
+        self.assertEqual(self.target.service_host(), 'servicehost')
+        self.assertEqual(self.target.service_password(), 'foobar')
+        self.joined_units.assert_not_called()
+        self.assertEqual(self.target.ssl_key(), 'key')
+        self.joined_units.assert_called_once_with()
+        self.assertEqual(self.target.read_counts, {
+            ('service_host', 'app'): 1,
+            ('service_password', 'app'): 1,
+            ('ssl_key', 'unit'): 1,
+        })
+        self.assertEqual(
+            [c[0][:2] for c in observer.call_args_list],
+            [('service_host', 'app'), ('service_password', 'app'),
+             ('ssl_key', 'unit')])
+        self.target.remove_read_observer(observer)
+        self.target.service_host()
+        self.assertEqual(observer.call_count, 3)
+
+    def _joined_units(self, relation, *unit_data):
+        units = []
+        for i, data in enumerate(unit_data):
+            unit = mock.MagicMock()
+            unit.unit_name = 'keystone/{}'.format(i)
+            unit.received_raw = data
+            units.append(unit)
+        joined_units = mock.PropertyMock(return_value=units)
+        type(relation).joined_units = joined_units
+        return joined_units
+
+    def _relation(self, relation_id, app_data, *unit_data):
+        relation = mock.MagicMock()
+        relation.relation_id = relation_id
+        relation.received_app_raw = app_data
+        self._joined_units(relation, *unit_data)
+        return relation
+
+    def test_for_relation(self):
+        self.target._relations = [
+            self._relation('identity-service:1', IDENTITY_APP_DATA,
+                           {'service_host': 'one', 'ssl_key': 'key'}),
+            self._relation('identity-service:2', {},
+                           {'region': 'RegionTwo', 'service_host': 'two'}),
+            self._relation('identity-service:3', {'region': 'RegionThree',
+                                                  'service-host': 'three'},
+                           {}),
+        ]
+        self.assertEqual(self.target.service_host(), 'servicehost')
+        self.assertEqual(self.target.ssl_key(), 'key')
+        self.assertEqual(self.target.relation_regions(), {
+            'identity-service:1': None,
+            'identity-service:2': 'RegionTwo',
+            'identity-service:3': 'RegionThree',
+        })
+        view = self.target.for_relation(region='RegionTwo')
+        self.assertEqual(view.service_host(), 'two')
+        self.assertIsNone(view.ssl_key())
+        self.assertIsNone(view.credentials)
+        view = self.target.for_relation(relation_id='identity-service:3')
+        self.assertEqual(view.service_host(), 'three')
+        self.assertIsNone(
+            self.target.for_relation(region='RegionFour').service_host())
+        self.assertEqual(
+            self.target.for_relation().service_host(), 'servicehost')
+        # views leave the endpoint and the flags it sets alone
+        self.assertEqual(self.target.service_host(), 'servicehost')
+        self.assertEqual(self.target.credentials.service_host, 'servicehost')
+        self._patch_kv()
+        flags = self._patch_flags()
+        self.target.update_flags()
+        self.assertIn('some-relation.available', flags)
+        with self.assertRaises(RuntimeError):
+            view.update_flags()
+        with self.assertRaises(RuntimeError):
+            view.update_change_flags()
+        with self.assertRaises(RuntimeError):
+            view.register_endpoints('nova', 'RegionOne', 'http://public',
+                                    'http://internal', 'http://admin')
+        self.assertIn('some-relation.available', flags)
+
+    def _patch_kv(self):
+        store = {}
+        kv = mock.MagicMock()
+        kv.get.side_effect = lambda k, d=None: json.loads(
+            json.dumps(store.get(k, d)))
+        kv.set.side_effect = store.__setitem__
+        self.patch_object(requires.unitdata, 'kv', return_value=kv)
+        return store
+
+    def _new_hook(self):
+        self._hooks += 1
+        os.environ['JUJU_CONTEXT_ID'] = 'hook-{}'.format(self._hooks)
+        relations = self.target._relations
+        self.target = requires.KeystoneRequires('some-relation', [])
+        self.target._relations = relations
+
+    def test_detect_protocols(self):
+        store = self._patch_kv()
+        classic = self._relation('identity-service:1', {},
+                                 {'service_host': 'classic'})
+        k8s = self._relation('identity-service:2', IDENTITY_APP_DATA,
+                             {'service_host': 'stale'})
+        pending = self._relation('identity-service:3', {}, {})
+        self.target._relations = [classic, k8s, pending]
+        self.assertEqual(self.target.detect_protocols(), {
+            'identity-service:1': 'unit',
+            'identity-service:2': 'app',
+        })
+        # the snapshot of the current hook follows the detected protocols
+        view = self.target.for_relation(relation_id='identity-service:2')
+        self.assertEqual(view.service_host(), 'servicehost')
+        self.assertIsNone(view.ssl_key())
+        self.assertEqual(store, {'some-relation.relation-protocols': {
+            'identity-service:1': 'unit',
+            'identity-service:2': 'app',
+        }})
+        # later hooks only read the bag of the detected protocol
+        self._new_hook()
+        classic_app = mock.PropertyMock(return_value={})
+        type(classic).received_app_raw = classic_app
+        k8s_units = self._joined_units(k8s, {'service_host': 'stale'})
+        view = self.target.for_relation(relation_id='identity-service:1')
+        self.assertEqual(view.service_host(), 'classic')
+        self.assertIsNone(view.ssl_key())
+        view = self.target.for_relation(relation_id='identity-service:2')
+        self.assertEqual(view.service_host(), 'servicehost')
+        self.assertIsNone(view.ssl_key())
+        classic_app.assert_not_called()
+        k8s_units.assert_not_called()
+
+    def test_detect_protocols_transitions(self):
+        store = self._patch_kv()
+        relation = self._relation('identity-service:1', {},
+                                  {'service_host': 'classic'})
+        self.target._relations = [relation]
+        self.assertEqual(self.target.detect_protocols(),
+                         {'identity-service:1': 'unit'})
+        # the classic units went away and keystone-k8s took over
+        self._new_hook()
+        relation.received_app_raw = IDENTITY_APP_DATA
+        self._joined_units(relation, {})
+        # read from both bags until detect_protocols() runs
+        self.assertEqual(self.target.service_host(), 'servicehost')
+        self.assertEqual(self.target.detect_protocols(),
+                         {'identity-service:1': 'app'})
+        self.assertEqual(self.target.service_host(), 'servicehost')
+        # and back to the classic charm
+        self._new_hook()
+        relation.received_app_raw = {}
+        self._joined_units(relation, {'service_host': 'classic'})
+        self.assertEqual(self.target.service_host(), 'classic')
+        self.assertEqual(self.target.detect_protocols(),
+                         {'identity-service:1': 'unit'})
+        # all data gone: back to reading both bags
+        self._new_hook()
+        self._joined_units(relation, {})
+        self.assertEqual(self.target.detect_protocols(), {})
+        self.assertEqual(store, {'some-relation.relation-protocols': {}})
+        self._joined_units(relation, {'ssl_key': 'key'})
+        self._new_hook()
+        self.assertEqual(self.target.ssl_key(), 'key')
+
+    def test_divergence(self):
+        store = self._patch_kv()
+        self.target._relations = [self._relation(
+            'identity-service:1', {},
+            dict(_juju_keys(0), service_port='5000', service_password='old',
+                 ep_changed='{"nova": "abc"}'),
+            dict(_juju_keys(1), service_port='5001', service_password='new'),
+            dict(_juju_keys(2), service_port='5001', service_password='new'),
+        )]
+        self.assertEqual(self.target.service_port(), 5000)
+        self.assertEqual(self.target.service_password(), 'old')
+        self.assertEqual(self.target.ep_changed(), {'nova': 'abc'})
+        report = self.target.divergence_report()
+        self.assertEqual(report['identity-service:1']['service_port'], {
+            'keystone/0': '5000',
+            'keystone/1': '5001',
+            'keystone/2': '5001',
+        })
+        passwords = report['identity-service:1']['service_password']
+        self.assertEqual(sorted(passwords), [
+            'keystone/0', 'keystone/1', 'keystone/2'])
+        self.assertNotIn('new', passwords.values())
+        self.assertNotIn('ep_changed', report['identity-service:1'])
+        # the addresses juju sets for each unit are not compared
+        self.assertEqual(sorted(report['identity-service:1']),
+                         ['service_password', 'service_port'])
+        self.target.configure_divergence_policy('majority')
+        self.assertEqual(store['some-relation.divergence-policy'],
+                         'majority')
+        self._new_hook()
+        self.assertEqual(self.target.service_port(), 5001)
+        self.assertEqual(self.target.service_password(), 'new')
+        self.assertEqual(self.target.ep_changed(), {'nova': 'abc'})
+        with self.assertRaises(ValueError):
+            self.target.configure_divergence_policy('random')
+
+    def test_register_regional_endpoints(self):
+        self.patch_object(requires.reactive, 'is_flag_set')
+        self.is_flag_set.return_value = False
+        relations = [
+            self._relation('identity-service:1', {}, {}),
+            self._relation('identity-service:2', {}, {'region': 'RegionTwo'}),
+            self._relation('identity-service:3', {}, {}),
+        ]
+        self.target._relations = relations
+        self.target.register_regional_endpoints({
+            'identity-service:1': {
+                'service': 's', 'region': 'RegionOne',
+                'public_url': 'p1', 'internal_url': 'i1', 'admin_url': 'a1'},
+            'RegionTwo': {
+                'service': 's', 'region': 'RegionTwo',
+                'public_url': 'p2', 'internal_url': 'i2', 'admin_url': 'a2'},
+        })
+        relations[0].to_publish_raw.update.assert_called_once_with({
+            'service': 's', 'region': 'RegionOne',
+            'public_url': 'p1', 'internal_url': 'i1', 'admin_url': 'a1'})
+        relations[1].to_publish_raw.update.assert_called_once_with({
+            'service': 's', 'region': 'RegionTwo',
+            'public_url': 'p2', 'internal_url': 'i2', 'admin_url': 'a2'})
+        relations[2].to_publish_raw.update.assert_not_called()
+
+    def test_credentials(self):
+        relation = mock.MagicMock()
+        relation.received_app_raw = dict(IDENTITY_APP_DATA)
+        self.target._relations = [relation]
+        creds = self.target.credentials
+        self.assertIs(self.target.credentials, creds)
+        self.assertEqual(creds.auth_port, 5000)
+        self.assertEqual(creds.service_port, 5000)
+        self.assertEqual(creds.api_version, 3)
+        self.assertEqual(creds.auth_url, 'http://authhost:5000')
+        self.assertEqual(creds.service_url, 'http://servicehost:5000')
+        self.assertEqual(creds.service_tenant, 'services')
+        self.assertEqual(creds.service_tenant_id,
+                         '0626e4d8-0846-4fd5-98c9-324fbbe24301')
+        self.assertEqual(creds.service_domain, 'service-domain')
+        with self.assertRaises(AttributeError):
+            creds.auth_port = 1
+        # IPv6 literals are bracketed, host names and IPv4 left alone
+        relation.received_app_raw.update({'auth-host': 'fd00::1',
+                                          'service-host': '10.0.0.1'})
+        self.target._snapshot = None
+        creds = self.target.credentials
+        self.assertEqual(creds.auth_host, 'fd00::1')
+        self.assertEqual(creds.auth_url, 'http://[fd00::1]:5000')
+        self.assertEqual(creds.service_url, 'http://10.0.0.1:5000')
+        # a new hook context rebuilds the credentials
+        relation.received_app_raw['auth-port'] = 'bad'
+        self.target._snapshot = None
+        self.assertIsNone(self.target.credentials)
+        del relation.received_app_raw['auth-port']
+        self.target._snapshot = None
+        self.assertIsNone(self.target.credentials)
+
     def test_ssl_data_complete(self):
         self.patch_target('ssl_cert_admin', '1')
         self.patch_target('ssl_cert_internal', '2')
@@ -148,57 +519,356 @@ class TestKeystoneRequires(test_utils.PatchHelper):
         self.ssl_key.return_value = '__null__'
         assert self.target.ssl_data_complete_legacy() is False
 
-    def test_changed(self):
-        self.patch_target('base_data_complete', False)
-        self.patch_target('ssl_data_complete', False)
-        self.patch_target('ssl_data_complete_legacy', False)
+    def test_complete_tiers(self):
+        self.patch_target('ssl_key', '1')
+        self.patch_target('ssl_cert', '2')
+        self.patch_target('ca_cert', '3')
+        for field in self.target.completeness_tiers['base'][1]:
+            self.patch_target(field, 'value')
+        self.assertEqual(self.target.complete_tiers(), {'base', 'ssl_legacy'})
+        self.ca_cert.assert_called_once_with()
+        self.service_host.assert_called_once_with()
+        self.service_host.return_value = None
+        self.ca_cert.reset_mock()
+        self.assertEqual(self.target.complete_tiers(), set())
+        self.ca_cert.assert_not_called()
+
+    def _patch_flags(self, *flags):
+        flags = set(flags)
+        self.patch_object(requires.reactive, 'is_flag_set')
+        self.is_flag_set.side_effect = lambda f: f in flags
         self.patch_object(requires.reactive, 'set_flag')
+        self.set_flag.side_effect = flags.add
         self.patch_object(requires.reactive, 'clear_flag')
+        self.clear_flag.side_effect = flags.discard
+        return flags
+
+    def test_changed(self):
+        self._patch_kv()
+        self.patch_target('complete_tiers', set())
+        self.patch_target('update_change_flags')
+        flags = self._patch_flags(
+            'some-relation.available', 'some-relation.available.auth',
+            'some-relation.available.ssl')
         # test when not all base data is available.
         self.target.changed()
         self.clear_flag.assert_any_call('some-relation.available')
         self.clear_flag.assert_any_call('some-relation.available.ssl')
-        self.clear_flag.assert_any_call(
-            'some-relation.available.ssl_legacy')
         self.clear_flag.assert_any_call('some-relation.available.auth')
         self.set_flag.assert_not_called()
         self.clear_flag.assert_any_call(
             'endpoint.some-relation.changed')
+        self.assertEqual(flags, set())
         self.clear_flag.reset_mock()
         # test when just the base data is available.
-        self.base_data_complete.return_value = True
+        self.complete_tiers.return_value = {'base'}
         self.target.changed()
         self.set_flag.assert_any_call('some-relation.available')
         self.set_flag.assert_any_call('some-relation.available.auth')
-        self.clear_flag.assert_any_call('some-relation.available.ssl')
-        self.clear_flag.assert_any_call(
-            'some-relation.available.ssl_legacy')
-        self.clear_flag.assert_any_call(
+        self.clear_flag.assert_called_once_with(
             'endpoint.some-relation.changed')
         self.set_flag.reset_mock()
         self.clear_flag.reset_mock()
         # test ssl_data_complete
-        self.ssl_data_complete.return_value = True
+        self.complete_tiers.return_value = {'base', 'ssl'}
         self.target.changed()
-        self.set_flag.assert_any_call('some-relation.available')
-        self.set_flag.assert_any_call('some-relation.available.auth')
-        self.set_flag.assert_any_call('some-relation.available.ssl')
-        self.clear_flag.assert_any_call(
-            'some-relation.available.ssl_legacy')
-        self.clear_flag.assert_any_call(
+        self.set_flag.assert_called_once_with('some-relation.available.ssl')
+        self.clear_flag.assert_called_once_with(
             'endpoint.some-relation.changed')
         self.set_flag.reset_mock()
         self.clear_flag.reset_mock()
         # test ssl_data_complete_legacy
-        self.ssl_data_complete_legacy.return_value = True
+        self.complete_tiers.return_value = {'base', 'ssl', 'ssl_legacy'}
         self.target.changed()
-        self.set_flag.assert_any_call('some-relation.available')
-        self.set_flag.assert_any_call('some-relation.available.auth')
-        self.set_flag.assert_any_call('some-relation.available.ssl')
-        self.set_flag.assert_any_call(
+        self.set_flag.assert_called_once_with(
             'some-relation.available.ssl_legacy')
-        self.clear_flag.assert_any_call(
+        self.clear_flag.assert_called_once_with(
             'endpoint.some-relation.changed')
+        self.assertEqual(flags, {
+            'some-relation.available', 'some-relation.available.auth',
+            'some-relation.available.ssl',
+            'some-relation.available.ssl_legacy'})
+
+    def test_update_flags_damping(self):
+        self._patch_kv()
+        flags = self._patch_flags()
+        self.patch_object(requires.KeystoneRequires, 'validate_ssl',
+                          return_value={'admin': [], 'internal': [],
+                                        'public': [], 'ca': []})
+        data = {field: field for tier in ('base', 'ssl')
+                for field in self.target.completeness_tiers[tier][1]}
+        data.update(service_port='5000', auth_port='35357')
+        relation = self._relation('identity-service:1', {}, data)
+        self.target._relations = [relation]
+        self.target.configure_damping(hooks=2)
+        self.target.update_flags()
+        self.target.update_change_flags()
+        self.assertIn('some-relation.available.ssl.valid', flags)
+        flags.difference_update(
+            [flag for flag in flags if '.changed.' in flag])
+        # keystone units restarting: partial but consistent data is held
+        self._joined_units(relation, dict(
+            data, service_password=None, ssl_key_admin=None))
+        for hook in range(2):
+            self._new_hook()
+            # counted once however often it runs in the hook
+            for _ in range(3):
+                self.assertEqual(self.target.update_flags(), (set(), set()))
+            self.assertEqual(self.target.update_change_flags(), set())
+            self.assertIn('some-relation.available', flags)
+            self.assertIn('some-relation.available.ssl.valid', flags)
+            # served the data last seen complete meanwhile
+            self.assertEqual(self.target.service_password(),
+                             'service_password')
+            self.assertEqual(self.target.ssl_key_admin(), 'ssl_key_admin')
+            self.assertEqual(self.target.credentials.service_password,
+                             'service_password')
+        self.assertEqual(
+            [entry['hooks'] for entry in self.target.damping_history()],
+            [1, 2])
+        self.assertEqual(self.target.damping_history()[0]['flags'], [
+            'some-relation.available', 'some-relation.available.auth',
+            'some-relation.available.ssl',
+            'some-relation.available.ssl.valid'])
+        self.assertFalse(
+            [flag for flag in flags if '.changed.' in flag])
+        # held for too long, until then the next hook sees the held data
+        self._new_hook()
+        self.assertEqual(self.target.service_password(), 'service_password')
+        self.assertEqual(self.target.update_flags()[1], {
+            'some-relation.available', 'some-relation.available.auth',
+            'some-relation.available.ssl',
+            'some-relation.available.ssl.valid'})
+        self.assertIsNone(self.target.service_password())
+        self.assertIn('auth', self.target.update_change_flags())
+        # complete again, then contradicting data clears straight away
+        self._joined_units(relation, data)
+        self._new_hook()
+        self.target.update_flags()
+        self._joined_units(relation, dict(
+            data, service_password=None, service_host='elsewhere'))
+        self._new_hook()
+        self.assertIn('some-relation.available',
+                      self.target.update_flags()[1])
+        self.assertEqual(self.target.service_host(), 'elsewhere')
+        # disabled
+        self._joined_units(relation, data)
+        self._new_hook()
+        self.target.update_flags()
+        self.target.configure_damping()
+        self._joined_units(relation, dict(data, service_password=None))
+        self._new_hook()
+        self.assertIn('some-relation.available',
+                      self.target.update_flags()[1])
+
+    def test_record_and_replay(self):
+        self._patch_kv()
+        flags = self._patch_flags()
+        self.patch_object(requires.hookenv, 'hook_name',
+                          return_value='identity-service-relation-changed')
+        data = {field: field for field in
+                self.target.completeness_tiers['base'][1]}
+        relation = self._relation('identity-service:1', {}, data)
+        self.target._relations = [relation]
+        recording = os.path.join(tempfile.mkdtemp(), 'recording.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(recording))
+        # off by default
+        self.target.changed()
+        self.assertFalse(os.path.exists(recording))
+        self.target.configure_recording(recording)
+        self._joined_units(relation, dict(data, service_password=None))
+        self._new_hook()
+        self.target.departed()
+        self._joined_units(relation, data)
+        self._new_hook()
+        self.target.changed()
+        self.assertIn('some-relation.available', flags)
+        with open(recording) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual([e['handler'] for e in entries],
+                         ['departed', 'changed'])
+        units = entries[1]['relations'][0]['units']
+        self.assertEqual(units[0][0], 'keystone/0')
+        self.assertTrue(units[0][1]['service_password'].startswith('sha256:'))
+        self.assertEqual(units[0][1]['service_host'], 'service_host')
+        self.assertEqual(entries[0]['flags'], [
+            'some-relation.changed.auth', 'some-relation.changed.endpoints'])
+
+        steps = requires.replay(recording, 'some-relation')
+        self.assertEqual([step['handler'] for step in steps],
+                         ['departed', 'changed'])
+        self.assertEqual(steps[0]['set'], [
+            'some-relation.changed.auth', 'some-relation.changed.endpoints'])
+        # the change flags of the previous hook were acted upon
+        self.assertEqual(steps[1]['set'], [
+            'some-relation.available', 'some-relation.available.auth',
+            'some-relation.changed.auth'])
+        self.assertEqual(steps[1]['cleared'], [])
+        self.assertEqual(steps[1]['flags'], steps[1]['recorded'])
+        self.assertIsInstance(steps[1]['seconds'], float)
+        # replayed offline, the flags of this unit are left alone
+        self.assertEqual(len(flags), 4)
+
+    def test_replay_unchanged(self):
+        self._patch_kv()
+        flags = self._patch_flags()
+        self.patch_object(requires.hookenv, 'hook_name',
+                          return_value='identity-service-relation-changed')
+        self.patch_object(requires.KeystoneRequires, 'validate_ssl',
+                          return_value={'admin': [], 'internal': [],
+                                        'public': [], 'ca': []})
+        data = {field: field for tier in ('base', 'ssl')
+                for field in self.target.completeness_tiers[tier][1]}
+        self.target._relations = [
+            self._relation('identity-service:1', {}, data)]
+        recording = os.path.join(tempfile.mkdtemp(), 'recording.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(recording))
+        self.target.configure_recording(recording)
+        for _ in range(3):
+            self._new_hook()
+            self.target.changed()
+            # the consuming charm acts on the change flags
+            flags.difference_update(
+                [flag for flag in flags if '.changed.' in flag])
+        self.assertIn('some-relation.available.ssl.valid', flags)
+        steps = requires.replay(recording, 'some-relation')
+        self.assertEqual(len(steps), 3)
+        for step in steps:
+            self.assertEqual(step['flags'], step['recorded'])
+        self.assertIn('some-relation.changed.auth', steps[0]['set'])
+        self.assertEqual(steps[1]['set'], [])
+        self.assertEqual(steps[2]['cleared'], [])
+
+    def test_instrumentation(self):
+        store = self._patch_kv()
+        self._patch_flags()
+        self.patch_object(requires.hookenv, 'hook_name',
+                          return_value='identity-service-relation-changed')
+        data = {field: field for field in
+                self.target.completeness_tiers['base'][1]}
+        self.target._relations = [
+            self._relation('identity-service:1', {}, data, data)]
+        kv = requires.unitdata.kv()
+        # off by default
+        self.target.changed()
+        self.target.update_flags()
+        self.assertEqual(self.target.instrumentation_report(), {})
+        self.assertEqual(self.target.io_counts['flag_writes'], 5)
+        # the setting is read once per hook
+        self.assertEqual(
+            [c for c in kv.get.call_args_list
+             if c[0][0] == 'some-relation.instrumentation'],
+            [mock.call('some-relation.instrumentation')])
+        self.target.configure_instrumentation()
+        self._new_hook()
+        self.target.changed()
+        self.target.update_flags()
+        report = self.target.instrumentation_report()
+        self.assertEqual(report['changed']['calls'], 1)
+        self.assertEqual(report['update_flags']['calls'], 2)
+        # the bags of both units, the app bag is known to be unused
+        self.assertEqual(report['changed']['relation_get'], 2)
+        self.assertEqual(report['changed']['relation_set'], 0)
+        # the trigger flag only, nothing changed since the previous hook
+        self.assertEqual(report['changed']['flag_writes'], 1)
+        self.assertEqual(report['update_flags']['flag_writes'], 0)
+        self.assertEqual(
+            sum(count for _, count in report['update_flags']['histogram']),
+            2)
+        self.assertIsNone(report['changed']['histogram'][-1][0])
+        # samples are rolled
+        for _ in range(3):
+            self.target.joined()
+        with mock.patch.object(requires.KeystoneRequires,
+                               '_instrumentation_window', 2):
+            self.target.joined()
+        self.assertEqual(
+            len(store['some-relation.instrumentation-samples']['joined']), 2)
+        self.target.configure_instrumentation(False)
+        self.target.joined()
+        self.assertEqual(
+            self.target.instrumentation_report()['joined']['calls'], 2)
+
+    def test_handlers_registered(self):
+        """Each handler is registered with charms.reactive on its own."""
+        spec = importlib.util.find_spec('requires')
+        module = importlib.util.module_from_spec(spec)
+        self.patch_object(requires.reactive.decorators.hookenv,
+                          'role_and_interface_to_relations',
+                          return_value=['identity-service'])
+        with mock.patch.object(requires.reactive.bus.Handler,
+                               '_HANDLERS', {}):
+            spec.loader.exec_module(module)
+            handlers = requires.reactive.bus.Handler.get_handlers()
+            self.assertEqual(
+                sorted((handler._action.__name__, handler._flags)
+                       for handler in handlers),
+                [('changed', {'endpoint.identity-service.changed'}),
+                 ('departed', {'endpoint.identity-service.departed'}),
+                 ('joined', {'endpoint.identity-service.joined'})])
+
+    def test_instrumentation_profile(self):
+        self._patch_kv()
+        self._patch_flags()
+        self.patch_object(requires.hookenv, 'hook_name',
+                          return_value='identity-service-relation-changed')
+        self.target._relations = [
+            self._relation('identity-service:1', IDENTITY_APP_DATA)]
+        report = os.path.join(tempfile.mkdtemp(), 'profile.txt')
+        self.addCleanup(shutil.rmtree, os.path.dirname(report))
+        with mock.patch.dict(requires.os.environ,
+                             {requires.PROFILE_ENV: report}):
+            self.target.changed()
+        with open(report) as f:
+            profile = f.read()
+        # only the outermost call is profiled
+        self.assertEqual(profile.count('# '), 1)
+        self.assertTrue(profile.startswith(
+            '# identity-service-relation-changed changed\n'))
+        self.assertIn('update_flags', profile)
+        self.assertEqual(self.target.instrumentation_report(), {})
+
+    def test_update_change_flags(self):
+        self._patch_kv()
+        flags = self._patch_flags()
+        relation = self._relation('identity-service:1', {}, {
+            'service_host': 'host',
+            'service_password': 'pass',
+            'ssl_key_public': 'key',
+            'ssl_cert_public': 'cert',
+            'ep_changed': {'nova': 'abc'},
+        })
+        self.target._relations = [relation]
+        self.assertEqual(self.target.update_change_flags(), {
+            'auth', 'endpoints', 'ssl.public', 'endpoint_checksums'})
+        self.assertEqual(flags, {
+            'some-relation.changed.auth',
+            'some-relation.changed.endpoints',
+            'some-relation.changed.ssl.public',
+            'some-relation.changed.endpoint_checksums',
+        })
+        flags.clear()
+        self._new_hook()
+        self.assertEqual(self.target.update_change_flags(), set())
+        self._joined_units(relation, dict(
+            self.target._received_data().units, ssl_cert_public='rotated'))
+        self._new_hook()
+        self.assertEqual(self.target.update_change_flags(), {'ssl.public'})
+        self.assertEqual(flags, {'some-relation.changed.ssl.public'})
+
+    def test_update_flags_transitions(self):
+        self._patch_kv()
+        self.patch_target('complete_tiers', {'base', 'ssl'})
+        self._patch_flags('some-relation.available',
+                          'some-relation.available.ssl_legacy')
+        self.assertEqual(self.target.update_flags(), (
+            {'some-relation.available.auth', 'some-relation.available.ssl'},
+            {'some-relation.available.ssl_legacy'}))
+        self.set_flag.reset_mock()
+        self.clear_flag.reset_mock()
+        self.assertEqual(self.target.update_flags(), (set(), set()))
+        self.set_flag.assert_not_called()
+        self.clear_flag.assert_not_called()
 
     def test_register_endpoints(self):
         self.patch_object(requires.reactive, 'is_flag_set')
@@ -220,17 +890,20 @@ class TestKeystoneRequires(test_utils.PatchHelper):
         # This should only happen when the charm is the leader and
         # register_endpoints is called with type and description
         # information.
+        document = json.dumps([{
+            "admin_url": "a_url",
+            "description": "sdesc",
+            "internal_url": "i_url",
+            "public_url": "p_url",
+            "service_name": "s",
+            "type": "stype"}],
+            sort_keys=True, separators=(',', ':')
+        )
         relation.to_publish_app_raw.update.assert_called_once_with({
             'region': 'r',
-            'service-endpoints': json.dumps([{
-                "admin_url": "a_url",
-                "description": "sdesc",
-                "internal_url": "i_url",
-                "public_url": "p_url",
-                "service_name": "s",
-                "type": "stype"}],
-                sort_keys=True
-            )
+            'service-endpoints': document,
+            'service-endpoints-digest': hashlib.sha256(
+                document.encode('utf-8')).hexdigest(),
         })
 
     def test_register_endpoints_requested_roles(self):
@@ -268,6 +941,188 @@ class TestKeystoneRequires(test_utils.PatchHelper):
         }
         relation.to_publish_raw.update.assert_called_once_with(result)
 
+    def test_register_endpoints_unchanged(self):
+        self.patch_object(requires.reactive, 'is_flag_set')
+        self.is_flag_set.return_value = True
+        relation = mock.MagicMock()
+        relation.to_publish_raw = mock.MagicMock(wraps={})
+        relation.to_publish_app_raw = mock.MagicMock(wraps={})
+        self.patch_target('_relations')
+        self._relations.__iter__.return_value = [relation]
+        args = ('s', 'r', 'p_url', 'i_url', 'a_url')
+        kwargs = {'service_type': 'stype', 'service_description': 'sdesc'}
+        self.target.register_endpoints(*args, **kwargs)
+        relation.to_publish_raw.update.assert_called_once_with({
+            'service': 's',
+            'public_url': 'p_url',
+            'internal_url': 'i_url',
+            'admin_url': 'a_url',
+            'region': 'r',
+        })
+        relation.to_publish_app_raw.update.assert_called_once()
+        relation.to_publish_raw.reset_mock()
+        relation.to_publish_app_raw.reset_mock()
+        # the same registration again publishes nothing
+        self.target.register_endpoints(*args, **kwargs)
+        relation.to_publish_raw.update.assert_not_called()
+        relation.to_publish_app_raw.update.assert_not_called()
+        # only the changed key is written
+        self.target.register_endpoints(
+            's', 'r', 'p_url2', 'i_url', 'a_url', **kwargs)
+        relation.to_publish_raw.update.assert_called_once_with(
+            {'public_url': 'p_url2'})
+        self.assertEqual(
+            sorted(relation.to_publish_app_raw.update.call_args[0][0]),
+            ['service-endpoints', 'service-endpoints-digest'])
+
+    def test_register_services(self):
+        self.patch_object(requires.reactive, 'is_flag_set')
+        self.is_flag_set.return_value = True
+        relation = mock.MagicMock()
+        self.patch_target('_relations')
+        self._relations.__iter__.return_value = [relation]
+        endpoints = [{
+            'service': 'cinderv3',
+            'public_url': 'p_url3',
+            'internal_url': 'i_url3',
+            'admin_url': 'a_url3',
+            'service_type': 'volumev3',
+            'service_description': 'v3',
+        }, {
+            'service': 'cinderv2',
+            'public_url': 'p_url2',
+            'internal_url': 'i_url2',
+            'admin_url': 'a_url2',
+            'service_type': 'volumev2',
+            'service_description': 'v2',
+        }]
+        self.target.register_services(endpoints, 'r',
+                                      requested_roles=['role1'])
+        relation.to_publish_raw.update.assert_called_once_with({
+            'service': None,
+            'public_url': None,
+            'internal_url': None,
+            'admin_url': None,
+            'region': None,
+            'cinderv3_service': 'cinderv3',
+            'cinderv3_public_url': 'p_url3',
+            'cinderv3_internal_url': 'i_url3',
+            'cinderv3_admin_url': 'a_url3',
+            'cinderv3_region': 'r',
+            'cinderv2_service': 'cinderv2',
+            'cinderv2_public_url': 'p_url2',
+            'cinderv2_internal_url': 'i_url2',
+            'cinderv2_admin_url': 'a_url2',
+            'cinderv2_region': 'r',
+            'requested_roles': 'role1',
+        })
+        document = json.dumps([{
+            "admin_url": "a_url2",
+            "description": "v2",
+            "internal_url": "i_url2",
+            "public_url": "p_url2",
+            "service_name": "cinderv2",
+            "type": "volumev2"}, {
+            "admin_url": "a_url3",
+            "description": "v3",
+            "internal_url": "i_url3",
+            "public_url": "p_url3",
+            "service_name": "cinderv3",
+            "type": "volumev3"}],
+            sort_keys=True, separators=(',', ':')
+        )
+        relation.to_publish_app_raw.update.assert_called_once_with({
+            'region': 'r',
+            'service-endpoints': document,
+            'service-endpoints-digest': hashlib.sha256(
+                document.encode('utf-8')).hexdigest(),
+        })
+
+    def test_encode_service_endpoints(self):
+        records = [{
+            'service_name': 'cinderv3',
+            'type': 'volumev3',
+            'description': 'v3',
+            'public_url': 'HTTPS://Cinder.Example.com:443/v3/',
+            'internal_url': 'http://10.0.0.1:80',
+            'admin_url': 'http://[fd00::1]:8776/v3/$(tenant_id)s',
+        }, {
+            'service_name': 'cinderv2',
+            'type': 'volumev2',
+            'description': 'v2',
+            'public_url': 'https://cinder.example.com:8776/v2',
+            'internal_url': 'p_url',
+            'admin_url': 'http://user@Admin:80/v2?x=1',
+        }]
+        document, digest = requires.encode_service_endpoints(records)
+        self.assertNotIn(' ', document.replace('"v3"', ''))
+        self.assertEqual(
+            digest, hashlib.sha256(document.encode('utf-8')).hexdigest())
+        decoded = json.loads(document)
+        self.assertEqual([r['service_name'] for r in decoded],
+                         ['cinderv2', 'cinderv3'])
+        self.assertEqual(decoded[1]['public_url'],
+                         'https://cinder.example.com/v3')
+        self.assertEqual(decoded[1]['internal_url'], 'http://10.0.0.1')
+        self.assertEqual(decoded[1]['admin_url'],
+                         'http://[fd00::1]:8776/v3/$(tenant_id)s')
+        self.assertEqual(decoded[0]['internal_url'], 'p_url')
+        self.assertEqual(decoded[0]['admin_url'], 'http://user@admin/v2?x=1')
+        # round trip and order independence
+        self.assertEqual(requires.encode_service_endpoints(decoded),
+                         (document, digest))
+        self.assertEqual(
+            requires.encode_service_endpoints(list(reversed(records))),
+            (document, digest))
+
+    def test_register_services_after_register_endpoints(self):
+        self._patch_flags()
+        relation = mock.MagicMock()
+        relation.to_publish_raw = {}
+        self.patch_target('_relations')
+        self._relations.__iter__.return_value = [relation]
+        self.target.register_endpoints('cinder', 'r', 'p_url', 'i_url',
+                                       'a_url')
+        self.assertEqual(relation.to_publish_raw['service'], 'cinder')
+        self.target.register_services([{
+            'service': 'cinderv3',
+            'public_url': 'p_url3',
+            'internal_url': 'i_url3',
+            'admin_url': 'a_url3',
+        }], 'r')
+        # the single endpoint keys go in the same write
+        self.assertEqual(self.target.io_counts['relation_set'], 2)
+        self.assertEqual(relation.to_publish_raw, {
+            'service': None,
+            'public_url': None,
+            'internal_url': None,
+            'admin_url': None,
+            'region': None,
+            'cinderv3_service': 'cinderv3',
+            'cinderv3_public_url': 'p_url3',
+            'cinderv3_internal_url': 'i_url3',
+            'cinderv3_admin_url': 'a_url3',
+            'cinderv3_region': 'r',
+        })
+
+    def test_register_services_invalid(self):
+        endpoint = {
+            'service': 'cinder',
+            'public_url': 'p_url',
+            'internal_url': 'i_url',
+            'admin_url': 'a_url',
+        }
+        with self.assertRaises(ValueError):
+            self.target.register_services(
+                [dict(endpoint, admin_url=None)], 'r')
+        with self.assertRaises(ValueError):
+            self.target.register_services(
+                [dict(endpoint, service='cinder_v2')], 'r')
+        with self.assertRaises(ValueError):
+            self.target.register_services([endpoint, endpoint], 'r')
+        with self.assertRaises(ValueError):
+            self.target.register_services([], 'r')
+
     def test_request_keystone_endpoint_information(self):
         relation = mock.MagicMock()
         self.patch_target('_relations')
@@ -291,6 +1146,213 @@ class TestKeystoneRequires(test_utils.PatchHelper):
         }
         self.target.request_notification(['nova', 'neutron'])
         relation.to_publish_raw.update.assert_called_once_with(result)
+        relation.to_publish_raw = mock.MagicMock(wraps=result)
+        self.target.request_notification(['nova', 'neutron'])
+        relation.to_publish_raw.update.assert_not_called()
+
+    def test_get_ssl_material(self):
+        requires._decode_pem.cache_clear()
+        pem = '-----BEGIN CERTIFICATE-----\nabc\n-----END CERTIFICATE-----\n'
+        encoded = base64.b64encode(pem.encode('utf-8')).decode('utf-8')
+        relation = mock.MagicMock()
+        relation.received_app_raw = {}
+        self.target._relations = [relation]
+        self.joined_units = self._joined_units(relation, {
+            'ssl_key_public': encoded,
+            'ssl_cert_public': encoded,
+            'ssl_cert': '',
+        })
+        self.patch_target('ca_cert', encoded)
+        self.assertEqual(self.target.get_ssl_key('public'), pem)
+        self.assertEqual(self.target.get_ssl_cert('public'), pem)
+        self.assertEqual(self.target.get_ssl_ca(), pem)
+        self.assertEqual(self.target.get_ssl_cert('public', as_bytes=True),
+                         pem.encode('utf-8'))
+        self.assertEqual(self.target.get_ssl_cert(), '')
+        self.assertIsNone(self.target.get_ssl_key('admin'))
+        self.ca_cert.assert_called_once_with()
+        info = self.target.pem_cache_info()
+        self.assertEqual((info.hits, info.misses), (3, 1))
+        self.ca_cert.return_value = None
+        self.assertIsNone(self.target.get_ssl_ca())
+        # binary material is only decoded to text when asked for text
+        der = b'\x30\x82\x01\xff'
+        self._joined_units(relation, {'ssl_cert': _b64(der)})
+        self._new_hook()
+        self.assertEqual(self.target.get_ssl_cert(as_bytes=True), der)
+        with self.assertRaises(UnicodeDecodeError):
+            self.target.get_ssl_cert()
+
+    def test_get_ssl_bundle(self):
+        relation = mock.MagicMock()
+        relation.received_app_raw = {}
+        self.target._relations = [relation]
+        self.joined_units = self._joined_units(relation, {
+            'ssl_key_admin': _b64(b'akey'),
+            'ssl_cert_admin': _b64(b'acert'),
+            'ssl_key_internal': _b64(b'ikey'),
+            'ssl_cert_internal': '__null__',
+            'ssl_key': _b64(b'key'),
+            'ssl_cert': _b64(b'cert'),
+        })
+        self.patch_target('ca_cert', _b64(b'ca'))
+        self.assertEqual(self.target.get_ssl_bundle(), {
+            'admin': {'key': 'akey', 'cert': 'acert'},
+            'internal': {'key': 'ikey', 'cert': None},
+            'public': {'key': None, 'cert': None},
+            'legacy': {'key': 'key', 'cert': 'cert'},
+            'ca': 'ca',
+            'missing': ['ssl_cert_internal', 'ssl_key_public',
+                        'ssl_cert_public'],
+        })
+        self.joined_units.assert_called_once_with()
+        self.assertEqual(
+            self.target.get_ssl_bundle(as_bytes=True)['admin']['key'],
+            b'akey')
+
+    @unittest.skipIf(requires._crypto() is None,
+                     'cryptography is not installed')
+    def test_validate_ssl(self):
+        from cryptography.hazmat.primitives.asymmetric import ec, rsa
+        store = self._patch_kv()
+        flags = self._patch_flags()
+        self.patch_target('complete_tiers', {'base', 'ssl', 'ssl_legacy'})
+        ca_key = rsa.generate_private_key(public_exponent=65537,
+                                          key_size=2048)
+        ca, ca_name = _make_cert('ca', ca_key)
+        data = {'ca_cert': _b64(ca)}
+        for cn in ('admin', 'internal', 'public'):
+            key = ec.generate_private_key(ec.SECP256R1())
+            cert, _ = _make_cert(cn, key, ca_key, ca_name)
+            data['ssl_key_' + cn] = _b64(_key_pem(key))
+            data['ssl_cert_' + cn] = _b64(cert)
+        other_key = ec.generate_private_key(ec.SECP256R1())
+        expired, _ = _make_cert('legacy', other_key, ca_key, ca_name,
+                                days=1, offset=-2)
+        data['ssl_key'] = _b64(_key_pem(other_key))
+        data['ssl_cert'] = _b64(expired)
+        relation = self._relation('identity-service:1', {}, data)
+        self.target._relations = [relation]
+        self.assertEqual(self.target.validate_ssl(), {
+            'ca': [], 'admin': [], 'internal': [], 'public': [],
+            'legacy': ['certificate is not valid at this time']})
+        self.target.update_flags()
+        self.assertIn('some-relation.available.ssl.valid', flags)
+        self.assertNotIn('some-relation.available.ssl_legacy.valid', flags)
+        self.assertEqual(len(store['some-relation.ssl-validation']), 5)
+        # checked once per distinct material
+        self._new_hook()
+        with mock.patch.object(self.target, '_check_ssl') as check_ssl:
+            self.target.update_flags()
+            check_ssl.assert_not_called()
+        # a key not matching its certificate, or a foreign CA
+        self._joined_units(relation, dict(
+            data, ssl_key_public=data['ssl_key_admin'],
+            ssl_cert=_b64(_make_cert('legacy', other_key)[0])))
+        self._new_hook()
+        validation = self.target.validate_ssl()
+        self.assertEqual(validation['public'],
+                         ['key does not match the certificate'])
+        self.assertEqual(validation['legacy'],
+                         ['certificate does not chain to the CA'])
+        self.target.update_flags()
+        self.assertNotIn('some-relation.available.ssl.valid', flags)
+        self.assertEqual(len(store['some-relation.ssl-validation']), 5)
+        # algorithms the cryptography library does not support
+        from cryptography.exceptions import UnsupportedAlgorithm
+        unsupported = UnsupportedAlgorithm('unsupported key type')
+        self._new_hook()
+        with mock.patch.object(
+                requires._crypto().serialization, 'load_pem_private_key',
+                side_effect=unsupported):
+            self.assertEqual(self.target._check_ssl(
+                data['ca_cert'], data['ssl_key_admin'],
+                data['ssl_cert_admin']), {'errors': [
+                    'invalid SSL material: unsupported key type']})
+        cert = mock.MagicMock()
+        type(cert).signature_hash_algorithm = mock.PropertyMock(
+            side_effect=unsupported)
+        issuer = mock.MagicMock(subject=cert.issuer)
+        issuer.public_key.return_value = ca_key.public_key()
+        self.assertFalse(requires._issued_by(cert, issuer))
+        # nothing validates without the cryptography library, and that
+        # is not cached
+        store.clear()
+        self._new_hook()
+        with mock.patch.object(requires, '_crypto', return_value=None):
+            self.assertEqual(self.target.validate_ssl()['admin'], [
+                'the cryptography library is not available'])
+            self.target.update_flags()
+        self.assertNotIn('some-relation.available.ssl.valid', flags)
+        self.assertFalse(store.get('some-relation.ssl-validation'))
+
+    def test_crypto_missing(self):
+        self.patch_object(requires.hookenv, 'log')
+        requires._crypto.cache_clear()
+        self.addCleanup(requires._crypto.cache_clear)
+        with mock.patch.dict(sys.modules, {'cryptography': None}):
+            self.assertIsNone(requires._crypto())
+            self.assertIsNone(requires._crypto())
+        # warned once
+        self.log.assert_called_once_with(
+            mock.ANY, level=requires.hookenv.WARNING)
+
+    def test_write_ssl_files(self):
+        data = {
+            'ssl_key_admin': _b64(b'akey'),
+            'ssl_cert_admin': _b64(b'acert'),
+            'ssl_key_public': _b64(b'pkey'),
+            'ssl_cert_public': '__null__',
+            'ca_cert': _b64(b'ca'),
+        }
+        relation = self._relation('identity-service:1', {}, data)
+        self.target._relations = [relation]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        def _path(name):
+            return os.path.join(tmpdir, 'ssl', name)
+
+        paths = {
+            'admin': {'key': _path('admin.key'), 'cert': _path('admin.crt')},
+            'public': {'key': _path('public.key'),
+                       'cert': _path('public.crt')},
+        }
+        self.assertEqual(
+            self.target.write_ssl_files(paths, ca_path=_path('ca.crt')),
+            {_path('admin.key'), _path('admin.crt'), _path('public.key'),
+             _path('ca.crt')})
+        with open(_path('admin.key')) as f:
+            self.assertEqual(f.read(), 'akey')
+        self.assertEqual(os.stat(_path('admin.key')).st_mode & 0o777, 0o600)
+        self.assertEqual(os.stat(_path('ca.crt')).st_mode & 0o777, 0o644)
+        self.assertFalse(os.path.exists(_path('public.crt')))
+        # nothing left behind, nothing rewritten
+        self.assertEqual(len(os.listdir(os.path.join(tmpdir, 'ssl'))), 4)
+        self._new_hook()
+        self.assertEqual(
+            self.target.write_ssl_files(paths, ca_path=_path('ca.crt')),
+            set())
+        # the mode and ownership of unchanged files are still corrected
+        os.chmod(_path('admin.key'), 0o644)
+        self._new_hook()
+        self.assertEqual(self.target.write_ssl_files(paths), set())
+        self.assertEqual(os.stat(_path('admin.key')).st_mode & 0o777, 0o600)
+        with mock.patch.object(requires.os, 'fchown') as fchown:
+            self.assertFalse(requires._write_file_atomic(
+                _path('admin.key'), b'akey', 0o600, os.getuid() + 1))
+            fchown.assert_called_once_with(mock.ANY, os.getuid() + 1, -1)
+            fchown.reset_mock()
+            self.assertFalse(requires._write_file_atomic(
+                _path('admin.key'), b'akey', 0o600, os.getuid()))
+            fchown.assert_not_called()
+        self._joined_units(relation, dict(
+            data, ssl_cert_admin=_b64(b'rotated')))
+        self._new_hook()
+        self.assertEqual(self.target.write_ssl_files(paths),
+                         {_path('admin.crt')})
+        with open(_path('admin.crt')) as f:
+            self.assertEqual(f.read(), 'rotated')
 
     def test_endpoint_checksums(self):
         self.patch_target('ep_changed')
@@ -302,3 +1364,28 @@ class TestKeystoneRequires(test_utils.PatchHelper):
             'neutron': '124252',
         }
         self.assertEqual(self.target.endpoint_checksums(), result)
+
+    def test_endpoint_checksums_raw(self):
+        self.patch_target('ep_changed', '{"nova": "abxcxv"}')
+        self.assertEqual(self.target.endpoint_checksums(), {'nova': 'abxcxv'})
+        self.ep_changed.return_value = 'garbage'
+        self.assertEqual(self.target.endpoint_checksums(), {})
+        self.ep_changed.return_value = None
+        self.assertEqual(self.target.endpoint_checksums(), {})
+
+    def test_changed_endpoints(self):
+        store = self._patch_kv()
+        self.patch_target('ep_changed',
+                          {'nova': 'abxcxv', 'neutron': '124252'})
+        self.assertEqual(self.target.changed_endpoints(),
+                         {'nova': 'abxcxv', 'neutron': '124252'})
+        self.target.ack_endpoint_changes(['nova'])
+        self.assertEqual(self.target.changed_endpoints(),
+                         {'neutron': '124252'})
+        self.target.ack_endpoint_changes()
+        self.assertEqual(self.target.changed_endpoints(), {})
+        self.ep_changed.return_value = {'nova': 'new', 'neutron': '124252'}
+        self.assertEqual(self.target.changed_endpoints(), {'nova': 'new'})
+        self.assertEqual(
+            store, {'some-relation.acked-endpoint-checksums': {
+                'nova': 'abxcxv', 'neutron': '124252'}})